@@ -0,0 +1,443 @@
+"""Offline load test for the Edge TTS server.
+
+The real edge_tts.Communicate is swapped for FakeCommunicate, a local
+stand-in with a configurable time to first chunk, chunk rate and error
+rate, so runs need no network access and are repeatable. Each
+configuration starts a fresh server via edge_server.create_server() in
+its own process (so peak RSS is measured per run), drives it with
+concurrent keep-alive clients and reports throughput, latency
+percentiles and peak RSS.
+
+With --upstream websocket the server instead talks to FakeEdgeService,
+a local WebSocket stand-in for the real service, through its pooled
+upstream client; this needs edge_tts and aiohttp installed. Compare
+--pool-size 0 against the default to see what connection reuse saves.
+
+Examples:
+    python benchmark.py
+    python benchmark.py --modes single,threaded --concurrency 1,8,32 --requests 500
+    python benchmark.py --endpoint stream --text-lengths 200,5000 --error-rate 0.05
+    python benchmark.py --upstream websocket --handshake-delay 0.1 --pool-size 0
+    python benchmark.py --stall-rate 0.03 --stall-seconds 3 --hedge-percentile 95
+"""
+import argparse
+import asyncio
+import html
+import http.client
+import itertools
+import json
+import logging
+import multiprocessing
+import random
+import re
+import sys
+import threading
+import time
+import types
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows; peak RSS is reported as unknown there
+    resource = None
+
+try:
+    import edge_tts
+except ImportError:
+    # The harness never talks to the real service, so it can run without edge_tts
+    edge_tts = types.ModuleType('edge_tts')
+    sys.modules['edge_tts'] = edge_tts
+
+import edge_server
+
+try:
+    from aiohttp import web
+except ImportError:
+    web = None
+
+ENDPOINTS = {
+    'json': '/tts',
+    'binary': '/tts?response=binary',
+    'stream': '/tts/stream',
+}
+
+WORDS = ("the quick brown fox jumps over a lazy dog while neural voices read "
+         "long articles chapters notices and prompts aloud").split()
+
+
+class FakeUpstreamError(Exception):
+    """Simulated failure of the upstream synthesis service"""
+
+
+class FakeCommunicate:
+    """Local stand-in for edge_tts.Communicate that streams silent audio
+
+    Timing and failure behaviour come from class attributes, which
+    configure() sets once per benchmark run. A stall_rate fraction of
+    syntheses wait an extra stall_seconds before their first chunk.
+    """
+    first_chunk_delay = 0.2
+    stall_rate = 0.0
+    stall_seconds = 0.0
+    chunks_per_second = 200
+    chunk_size = 4096
+    bytes_per_char = 400
+    error_rate = 0.0
+
+    def __init__(self, text, voice='en-US-AriaNeural', rate='+0%', **kwargs):
+        self.text = text
+        self.voice = voice
+        self.rate = rate
+
+    @classmethod
+    def configure(cls, first_chunk_delay, chunks_per_second, error_rate, stall_rate=0.0, stall_seconds=0.0):
+        cls.first_chunk_delay = first_chunk_delay
+        cls.chunks_per_second = chunks_per_second
+        cls.error_rate = error_rate
+        cls.stall_rate = stall_rate
+        cls.stall_seconds = stall_seconds
+
+    async def stream(self):
+        stalled = random.random() < self.stall_rate
+        await asyncio.sleep(self.first_chunk_delay + (self.stall_seconds if stalled else 0))
+        if random.random() < self.error_rate:
+            raise FakeUpstreamError('Simulated upstream failure')
+
+        words = self.text.split()
+        total_bytes = max(len(self.text) * self.bytes_per_char, self.chunk_size)
+        chunk_count = -(-total_bytes // self.chunk_size)
+        words_per_chunk = -(-len(words) // chunk_count) if words else 0
+        offset = 0
+        for index in range(chunk_count):
+            for word in words[index * words_per_chunk:(index + 1) * words_per_chunk]:
+                yield {'type': 'WordBoundary', 'offset': offset, 'duration': 2_500_000, 'text': word}
+                offset += 3_000_000
+            yield {'type': 'audio', 'data': bytes(min(self.chunk_size, total_bytes - index * self.chunk_size))}
+            if index + 1 < chunk_count:
+                await asyncio.sleep(1 / self.chunks_per_second)
+
+    async def save(self, filename):
+        with open(filename, 'wb') as audio_file:
+            async for chunk in self.stream():
+                if chunk['type'] == 'audio':
+                    audio_file.write(chunk['data'])
+
+
+class FakeEdgeService:
+    """Local WebSocket stand-in for the Edge TTS service
+
+    Speaks enough of the wire protocol for edge_tts and the server's
+    upstream pool: every SSML request on a connection is answered with
+    the events of a FakeCommunicate, followed by turn.end. Handshakes
+    can be slowed down to mimic TLS, and connections closed after a
+    number of turns to exercise reconnecting.
+    """
+
+    def __init__(self, handshake_delay=0.1, turns_per_connection=0):
+        self.handshake_delay = handshake_delay
+        self.turns_per_connection = turns_per_connection
+        self.handshakes = 0
+        self.url = None
+
+    def start(self):
+        """Serve on a free local port from a background thread"""
+        loop = asyncio.new_event_loop()
+        ready = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            app = web.Application()
+            app.router.add_get('/edge', self.handle)
+            runner = web.AppRunner(app)
+            loop.run_until_complete(runner.setup())
+            loop.run_until_complete(web.TCPSite(runner, '127.0.0.1', 0).start())
+            self.url = f"ws://127.0.0.1:{runner.addresses[0][1]}/edge"
+            ready.set()
+            loop.run_forever()
+
+        threading.Thread(target=run, daemon=True).start()
+        ready.wait()
+
+    async def handle(self, request):
+        await asyncio.sleep(self.handshake_delay)
+        self.handshakes += 1
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        turns = 0
+        async for message in websocket:
+            headers, _, body = message.data.partition('\r\n\r\n')
+            if 'Path:ssml' not in headers:
+                continue
+            request_id = re.search(r'X-RequestId:(\w+)', headers).group(1)
+            if not await self.speak(websocket, request_id, html.unescape(re.sub(r'<[^>]+>', '', body))):
+                break
+            turns += 1
+            if self.turns_per_connection and turns >= self.turns_per_connection:
+                break
+        await websocket.close()
+        return websocket
+
+    async def speak(self, websocket, request_id, text):
+        """Answer one turn; returns False if the simulated upstream failed"""
+        text_headers = f"X-RequestId:{request_id}\r\nContent-Type:application/json; charset=utf-8\r\n"
+        audio_headers = f"X-RequestId:{request_id}\r\nContent-Type:audio/mpeg\r\nPath:audio\r\n".encode()
+        await websocket.send_str(f"{text_headers}Path:turn.start\r\n\r\n{{}}")
+        try:
+            async for event in FakeCommunicate(text).stream():
+                if event['type'] == 'audio':
+                    await websocket.send_bytes(len(audio_headers).to_bytes(2, 'big') + audio_headers + event['data'])
+                    continue
+                metadata = {'Type': event['type'], 'Data': {
+                    'Offset': event['offset'], 'Duration': event['duration'],
+                    'text': {'Text': event['text'], 'Length': len(event['text']), 'BoundaryType': event['type']},
+                }}
+                await websocket.send_str(f"{text_headers}Path:audio.metadata\r\n\r\n"
+                                         + json.dumps({'Metadata': [metadata]}))
+        except (FakeUpstreamError, ConnectionResetError):
+            # A simulated failure, or the client hung up (e.g. a hedge that lost)
+            return False
+        await websocket.send_str(f"{text_headers}Path:turn.end\r\n\r\n{{}}")
+        return True
+
+
+def make_texts(count, lengths, repeat_ratio, seed):
+    """Build the request texts: unique by default, repeated at repeat_ratio"""
+    rng = random.Random(seed)
+    texts = []
+    for index in range(count):
+        if texts and rng.random() < repeat_ratio:
+            texts.append(rng.choice(texts))
+            continue
+        length = rng.choice(lengths)
+        words = [f"Request {index}."]
+        while sum(len(word) + 1 for word in words) < length:
+            words.append(rng.choice(WORDS))
+        texts.append(' '.join(words)[:length])
+    return texts
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not values:
+        return None
+    index = min(len(values) - 1, max(0, int(round(fraction * len(values) + 0.5)) - 1))
+    return values[index]
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def send_request(connection, endpoint, text):
+    """Issue one request and return (ok, seconds to first body byte, bytes received)"""
+    started = time.perf_counter()
+    connection.request('POST', ENDPOINTS[endpoint], body=json.dumps({'text': text}),
+                       headers={'Content-Type': 'application/json'})
+    response = connection.getresponse()
+    first = response.read1(65536) if endpoint == 'stream' else b''
+    first_byte = time.perf_counter() - started
+    body = first + response.read()
+    if response.status != 200:
+        return False, first_byte, len(body)
+    if endpoint == 'json':
+        return json.loads(body).get('success', False), first_byte, len(body)
+    return True, first_byte, len(body)
+
+
+def run_once(config):
+    """Run one benchmark configuration against a fresh server and return its results"""
+    random.seed(config['seed'])
+    FakeCommunicate.configure(config['first_chunk_delay'], config['chunks_per_second'], config['error_rate'],
+                              config['stall_rate'], config['stall_seconds'])
+    service = None
+    if config['upstream'] == 'websocket':
+        service = FakeEdgeService(config['handshake_delay'], config['turns_per_connection'])
+        service.start()
+        # Without the pool the server falls back to edge_tts.Communicate, so point that at the stand-in too
+        edge_tts.communicate.WSS_URL = service.url + '?TrustedClientToken=benchmark'
+        upstream = {'upstream_pool_size': config['pool_size'], 'upstream_url': service.url}
+    else:
+        edge_tts.Communicate = FakeCommunicate
+        upstream = {'upstream_pool_size': 0}
+
+    # Every client comes from 127.0.0.1, so a per-client rate limit would throttle the whole run
+    server = edge_server.create_server('127.0.0.1', 0, mode=config['mode'],
+                                       max_concurrency=config['max_concurrency'],
+                                       client_chars_per_second=0, hedge_percentile=config['hedge_percentile'] / 100,
+                                       **upstream)
+    port = server.server_address[1]
+    server_thread = threading.Thread(target=server.serve_forever, daemon=True)
+    server_thread.start()
+
+    texts = make_texts(config['requests'], config['text_lengths'], config['repeat_ratio'], config['seed'])
+    next_index = itertools.count()
+    samples = []
+    samples_lock = threading.Lock()
+
+    def client():
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=config['timeout'])
+        while True:
+            index = next(next_index)
+            if index >= len(texts):
+                break
+            started = time.perf_counter()
+            try:
+                ok, first_byte, size = send_request(connection, config['endpoint'], texts[index])
+            except (OSError, http.client.HTTPException):
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=config['timeout'])
+                ok, first_byte, size = False, None, 0
+            with samples_lock:
+                samples.append((ok, time.perf_counter() - started, first_byte, size))
+        connection.close()
+
+    started = time.perf_counter()
+    clients = [threading.Thread(target=client) for _ in range(config['concurrency'])]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    server.shutdown()
+    server.server_close()
+    server.engine.stop()
+
+    latencies = sorted(latency for ok, latency, _, _ in samples if ok)
+    first_bytes = sorted(first_byte for ok, _, first_byte, _ in samples if ok)
+    return {
+        **{key: config[key] for key in ('mode', 'endpoint', 'concurrency', 'requests')},
+        'errors': sum(1 for ok, _, _, _ in samples if not ok),
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(len(latencies) / elapsed, 2) if elapsed else None,
+        'mb_received': round(sum(size for _, _, _, size in samples) / (1024 * 1024), 2),
+        'p50_ms': ms(percentile(latencies, 0.50)),
+        'p95_ms': ms(percentile(latencies, 0.95)),
+        'p99_ms': ms(percentile(latencies, 0.99)),
+        'ttfb_p50_ms': ms(percentile(first_bytes, 0.50)) if config['endpoint'] == 'stream' else None,
+        'peak_rss_mb': round(peak_rss_mb(), 1) if resource is not None else None,
+        'handshakes': service.handshakes if service is not None else None,
+    }
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+def run_isolated(config):
+    """Run a configuration in a child process so peak RSS belongs to that run alone"""
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_run_child, args=(config, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def _run_child(config, results):
+    if not config['verbose']:
+        # Simulated upstream failures are expected, so only show real crashes
+        logging.getLogger().setLevel(logging.CRITICAL)
+    results.put(run_once(config))
+
+
+def print_table(rows):
+    columns = ['mode', 'endpoint', 'concurrency', 'requests', 'errors', 'throughput_rps',
+               'p50_ms', 'p95_ms', 'p99_ms', 'ttfb_p50_ms', 'peak_rss_mb', 'handshakes']
+    widths = {column: max(len(column), *(len(str(row[column])) for row in rows)) for column in columns}
+    print('  '.join(column.rjust(widths[column]) for column in columns))
+    for row in rows:
+        print('  '.join(str(row[column]).rjust(widths[column]) for column in columns))
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmark for the Edge TTS server")
+    parser.add_argument('--modes', default='threaded',
+                        help=f"Comma-separated server modes to compare ({', '.join(edge_server.SERVER_MODES)})")
+    parser.add_argument('--endpoint', choices=sorted(ENDPOINTS), default='binary',
+                        help="Which /tts flavour to drive (default: %(default)s)")
+    parser.add_argument('--concurrency', type=int_list, default=[1, 8, 32],
+                        help="Comma-separated numbers of concurrent clients (default: 1,8,32)")
+    parser.add_argument('--requests', type=int, default=100, help="Requests per run (default: %(default)s)")
+    parser.add_argument('--text-lengths', type=int_list, default=[100, 500, 2000],
+                        help="Comma-separated text lengths to mix (default: 100,500,2000)")
+    parser.add_argument('--repeat-ratio', type=float, default=0.0,
+                        help="Fraction of requests that repeat an earlier text (default: %(default)s)")
+    parser.add_argument('--first-chunk-delay', type=float, default=0.2,
+                        help="Fake upstream time to first chunk in seconds (default: %(default)s)")
+    parser.add_argument('--chunks-per-second', type=float, default=200,
+                        help="Fake upstream chunk rate (default: %(default)s)")
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help="Fraction of fake upstream syntheses that fail (default: %(default)s)")
+    parser.add_argument('--stall-rate', type=float, default=0.0,
+                        help="Fraction of fake syntheses that stall before their first chunk (default: %(default)s)")
+    parser.add_argument('--stall-seconds', type=float, default=3.0,
+                        help="How long a stalled fake synthesis waits (default: %(default)s)")
+    parser.add_argument('--hedge-percentile', type=float, default=0,
+                        help="Server hedging percentile, 0 to disable (default: %(default)s)")
+    parser.add_argument('--upstream', choices=['fake', 'websocket'], default='fake',
+                        help="Replace Communicate in-process, or serve a local WebSocket stand-in (default: %(default)s)")
+    parser.add_argument('--pool-size', type=int, default=edge_server.UPSTREAM_POOL_SIZE,
+                        help="Server upstream pool size with --upstream websocket, 0 for none (default: %(default)s)")
+    parser.add_argument('--handshake-delay', type=float, default=0.1,
+                        help="Stand-in WebSocket handshake time in seconds (default: %(default)s)")
+    parser.add_argument('--turns-per-connection', type=int, default=0,
+                        help="Stand-in closes a connection after this many turns, 0 for never (default: %(default)s)")
+    parser.add_argument('--max-concurrency', type=int, default=edge_server.MAX_CONCURRENT_SYNTHESIS,
+                        help="Server synthesis concurrency limit (default: %(default)s)")
+    parser.add_argument('--timeout', type=float, default=120, help="Client socket timeout in seconds")
+    parser.add_argument('--seed', type=int, default=1234, help="Seed for texts and simulated errors")
+    parser.add_argument('--output', help="Also write the results as JSON to this file")
+    parser.add_argument('--verbose', action='store_true', help="Keep the server's INFO logging")
+    args = parser.parse_args(argv)
+    if args.upstream == 'websocket' and (web is None or edge_server.aiohttp is None):
+        parser.error("--upstream websocket needs edge_tts and aiohttp installed")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    rows = []
+    for mode in [mode for mode in args.modes.split(',') if mode]:
+        for concurrency in args.concurrency:
+            config = {
+                'mode': mode,
+                'endpoint': args.endpoint,
+                'concurrency': concurrency,
+                'requests': args.requests,
+                'text_lengths': args.text_lengths,
+                'repeat_ratio': args.repeat_ratio,
+                'first_chunk_delay': args.first_chunk_delay,
+                'chunks_per_second': args.chunks_per_second,
+                'error_rate': args.error_rate,
+                'stall_rate': args.stall_rate,
+                'stall_seconds': args.stall_seconds,
+                'hedge_percentile': args.hedge_percentile,
+                'upstream': args.upstream,
+                'pool_size': args.pool_size,
+                'handshake_delay': args.handshake_delay,
+                'turns_per_connection': args.turns_per_connection,
+                'max_concurrency': args.max_concurrency,
+                'timeout': args.timeout,
+                'seed': args.seed,
+                'verbose': args.verbose,
+            }
+            rows.append(run_isolated(config))
+            print(f"done: mode={mode} concurrency={concurrency}", file=sys.stderr)
+
+    print_table(rows)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(rows, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,26 +1,2023 @@
+import argparse
 import asyncio
 import base64
-from http.server import HTTPServer, SimpleHTTPRequestHandler
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import gzip
+import hashlib
+from http.server import HTTPServer, SimpleHTTPRequestHandler, ThreadingHTTPServer
 import json
 import edge_tts
-import tempfile
+import http.client
+import io
 import os
+import queue
+import re
+import shutil
+import signal
+import socket
+import ssl
+import subprocess
+import threading
 import time
 import logging
+import math
+import mmap
+import multiprocessing
+import struct
+import tempfile
+import unicodedata
+import uuid
+import zlib
+from collections import OrderedDict, deque
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape, unescape
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    import aiohttp
+    import certifi
+    from edge_tts.communicate import (connect_id, date_to_string, get_headers_and_data, mkssml,
+                                      remove_incompatible_characters, split_text_by_byte_length,
+                                      ssml_headers_plus_data)
+    from edge_tts.constants import SEC_MS_GEC_VERSION, WSS_HEADERS, WSS_URL
+    from edge_tts.data_classes import TTSConfig
+    from edge_tts.drm import DRM
+except ImportError:
+    # Without these (e.g. an older edge_tts) every synthesis uses its own edge_tts.Communicate
+    aiohttp = None
+
+# Set up logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Server defaults
+DEFAULT_HOST = 'localhost'
+DEFAULT_PORT = 8000
+DEFAULT_MODE = 'threaded'
+MAX_CONCURRENT_SYNTHESIS = 8
+MAX_TEXT_LENGTH = 100000
+SEGMENT_MAX_CHARS = 1500
+SEGMENT_WORKERS = 4
+BATCH_WORKERS = 8
+MAX_BATCH_JOBS = 500
+JOB_WORKERS = 4
+MAX_QUEUED_JOBS = 1000
+JOB_RETENTION = 600
+SSE_HEARTBEAT = 15
+TRANSCODE_WORKERS = 2
+KEEPALIVE_TIMEOUT = 15
+PREVIEW_MAX_AGE = 7 * 24 * 3600
+MAX_KEEPALIVE_REQUESTS = 100
+UPSTREAM_POOL_SIZE = 8
+UPSTREAM_IDLE_TIMEOUT = 30
+UPSTREAM_MAX_AGE = 240
+FIRST_CHUNK_TIMEOUT = 15
+SYNTHESIS_TIMEOUT = 120
+HEDGE_PERCENTILE = 0
+HEDGE_MIN_SAMPLES = 20
+HEDGE_WINDOW = 500
+DRAIN_TIMEOUT = 30
+
+# Upstream audio is 48 kbit/s CBR MP3; boundary offsets are in 100 ns ticks
+AUDIO_BITRATE = 48000
+TICKS_PER_SECOND = 10_000_000
+
+# Admission control; a limit of 0 disables it
+MAX_IN_FLIGHT_REQUESTS = 32
+MAX_WAITING_REQUESTS = 64
+ADMISSION_TIMEOUT = 10
+CLIENT_CHARS_PER_SECOND = 2000
+CLIENT_BURST_CHARS = 20000
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_TTL = 3600
+STORE_MAX_BYTES = 1024 * 1024 * 1024
+# How many /audio/ URLs of memory-cached clips are remembered
+AUDIO_URL_ENTRIES = 10000
+AUDIO_MAX_AGE = 365 * 24 * 3600
+# Request headers passed on when another worker is asked for an /audio/ clip
+AUDIO_FORWARDED_HEADERS = ('Range', 'If-Range', 'If-None-Match')
+
+# Layout of the disk store's index: a magic header, then fixed-size slots of
+# (key digest, content digest, file extension, size, last use) plus a CRC32
+STORE_INDEX_MAGIC = b'TTSIDX02'
+STORE_RECORD = struct.Struct('<16s32s4sQd')
+STORE_SLOT_SIZE = STORE_RECORD.size + 4
+STORE_INITIAL_SLOTS = 1024
+
+SERVER_MODES = {
+    'single': HTTPServer,
+    'threaded': ThreadingHTTPServer,
+}
+
+
+class Metrics:
+    """Thread-safe counters, gauges and histograms in Prometheus text format"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._descriptions = {}
+        self._values = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def describe(self, name, kind, help_text):
+        """Declare a metric so it is exported with HELP and TYPE lines"""
+        self._descriptions[name] = (kind, help_text)
+
+    def inc(self, name, value=1, **labels):
+        """Add value to a counter or gauge"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def get(self, name, **labels):
+        """Return the current value of a counter or gauge"""
+        with self._lock:
+            return self._values.get((name, tuple(sorted(labels.items()))), 0)
+
+    def set(self, name, value, **labels):
+        """Set a gauge, or mirror a counter kept elsewhere"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._values[key] = value
+
+    def observe(self, name, value, **labels):
+        """Record one sample in a histogram"""
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[0][i] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Observe how long the with-block takes, in seconds"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _format_labels(labels):
+        if not labels:
+            return ''
+        parts = []
+        for name, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{name}="{value}"')
+        return '{' + ','.join(parts) + '}'
+
+    def render(self):
+        """Return every metric in the Prometheus text exposition format"""
+        with self._lock:
+            values = dict(self._values)
+            histograms = {key: (list(counts), total, count)
+                          for key, (counts, total, count) in self._histograms.items()}
+        
+        lines = []
+        names = sorted(self._descriptions.keys() | {name for name, _ in values} | {name for name, _ in histograms})
+        for name in names:
+            kind, help_text = self._descriptions.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for (metric, labels), value in sorted(values.items()):
+                if metric == name:
+                    lines.append(f'{name}{self._format_labels(labels)} {value}')
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f'{name}_bucket{self._format_labels(labels + (("le", bound),))} {bucket_count}')
+                lines.append(f'{name}_bucket{self._format_labels(labels + (("le", "+Inf"),))} {count}')
+                lines.append(f'{name}_sum{self._format_labels(labels)} {total}')
+                lines.append(f'{name}_count{self._format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('tts_stage_duration_seconds', 'histogram',
+                 'Time spent in each pipeline stage (queue, first_chunk, upstream, transcode, encode, write, job_queue)')
+metrics.describe('tts_http_request_duration_seconds', 'histogram', 'Time from request line to finished response, by route')
+metrics.describe('tts_http_requests_total', 'counter', 'HTTP requests served, by route and status')
+metrics.describe('tts_http_requests_in_flight', 'gauge', 'HTTP requests currently being handled')
+metrics.describe('tts_syntheses_in_flight', 'gauge', 'Upstream syntheses currently running')
+metrics.describe('tts_syntheses_queued', 'gauge', 'Upstream syntheses waiting for a free synthesis slot')
+metrics.describe('tts_jobs_queued', 'gauge', 'Asynchronous jobs waiting for a worker')
+metrics.describe('tts_admission_waiting', 'gauge', 'Requests waiting for an in-flight slot')
+metrics.describe('tts_admission_rejected_total', 'counter', 'Requests turned away with 429, by reason')
+metrics.describe('tts_upstream_errors_total', 'counter', 'Failed upstream syntheses, by exception type')
+metrics.describe('tts_upstream_connections_total', 'counter',
+                 'Upstream WebSocket connections used, by whether they were opened or reused')
+metrics.describe('tts_upstream_connections_idle', 'gauge', 'Warm upstream connections waiting in the pool')
+metrics.describe('tts_hedged_requests_total', 'counter',
+                 'Hedge syntheses started, and whether they or the original produced audio first')
+metrics.describe('tts_coalesced_requests_total', 'counter',
+                 'Requests that joined an identical synthesis already in flight, by stage')
+metrics.describe('tts_response_bytes_total', 'counter', 'Response body bytes written, by route')
+metrics.describe('tts_characters_total', 'counter', 'Characters synthesized upstream, by voice')
+metrics.describe('tts_words_total', 'counter', 'Words synthesized upstream, by voice')
+metrics.describe('tts_cache_hits_total', 'counter', 'Audio cache hits')
+metrics.describe('tts_cache_misses_total', 'counter', 'Audio cache misses')
+metrics.describe('tts_cache_evictions_total', 'counter', 'Audio cache evictions')
+metrics.describe('tts_cache_bytes', 'gauge', 'Bytes of audio held in the cache')
+metrics.describe('tts_cache_entries', 'gauge', 'Clips held in the cache')
+metrics.describe('tts_segment_cache_total', 'counter',
+                 'Sentence lookups while synthesizing long texts, by hit or miss')
+metrics.describe('tts_canonicalized_requests_total', 'counter',
+                 'Requests rewritten into canonical form before keying, by field')
+metrics.describe('tts_store_hits_total', 'counter', 'Disk store hits')
+metrics.describe('tts_store_misses_total', 'counter', 'Disk store misses')
+metrics.describe('tts_store_evictions_total', 'counter', 'Disk store evictions')
+metrics.describe('tts_store_bytes', 'gauge', 'Bytes of audio held in the disk store')
+metrics.describe('tts_store_entries', 'gauge', 'Keys held in the disk store')
+
+
+class AudioCache:
+    """Thread-safe in-memory LRU cache of synthesized audio.
+
+    Entries are evicted least-recently-used first once the total size of
+    the cached audio exceeds max_bytes, and expire ttl seconds after they
+    were stored (a ttl of 0 keeps them until evicted).
+    """
+
+    def __init__(self, max_bytes=CACHE_MAX_BYTES, ttl=CACHE_TTL):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, count_miss=True, count_hit=True):
+        """Return cached audio for key, or None on a miss
+
+        A lookup that falls through to another one for the same key passes
+        count_miss=False, so that the miss is only counted once. Lookups
+        counted by a metric of their own pass count_hit=False as well.
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += count_miss
+                return None
+            data, expires_at = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += count_miss
+                return None
+            self._entries.move_to_end(key)
+            self.hits += count_hit
+            return data
+
+    def put(self, key, data):
+        """Store audio under key, evicting older entries to stay within budget"""
+        if len(data) > self.max_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl if self.ttl else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (data, expires_at)
+            self.current_bytes += len(data)
+            while self.current_bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        data, _ = self._entries.pop(key)
+        self.current_bytes -= len(data)
+
+    def stats(self):
+        """Return a snapshot of the cache counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class AudioStore:
+    """Persistent content-addressed store of synthesized audio on disk.
+
+    Clips are files named by the SHA-256 of their contents, so identical
+    audio is only kept once; MP3 clips carry their word timings in front
+    of the audio (see pack_entry). A memory-mapped index of fixed-size
+    records maps each cache key to its clip, which lets the store open
+    without scanning the directory. Clips are written to a temporary file, synced
+    and renamed into place before the index points at them, so a crash
+    never exposes partial audio. Once the clips exceed max_bytes the least
+    recently used keys are evicted.
+    """
+
+    def __init__(self, directory, max_bytes=STORE_MAX_BYTES, peers=()):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        # Other stores whose clips may be read (never written) by content digest
+        self.peers = tuple(peers)
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # key digest -> (slot, content digest, extension, size), least recently used first
+        self._entries = OrderedDict()
+        self._refs = {}
+        self._free_slots = []
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        for entry in os.scandir(directory):
+            # Left behind by a write that never got renamed into place
+            if entry.name.endswith('.tmp'):
+                os.unlink(entry.path)
+        self._open_index(os.path.join(directory, 'index'))
+
+    def _open_index(self, path):
+        self._file = open(path, 'r+b' if os.path.exists(path) else 'w+b')
+        header = self._file.read(len(STORE_INDEX_MAGIC))
+        size = os.fstat(self._file.fileno()).st_size
+        if header != STORE_INDEX_MAGIC:
+            if size:
+                logger.warning(f"Unrecognized audio store index at {path}, starting empty")
+            self._file.seek(0)
+            self._file.write(STORE_INDEX_MAGIC)
+            size = len(STORE_INDEX_MAGIC) + STORE_INITIAL_SLOTS * STORE_SLOT_SIZE
+            self._file.truncate(size)
+            self._file.flush()
+        self._capacity = (size - len(STORE_INDEX_MAGIC)) // STORE_SLOT_SIZE
+        self._index = mmap.mmap(self._file.fileno(), 0)
+        
+        records = []
+        for slot in range(self._capacity):
+            offset = self._offset(slot)
+            raw = self._index[offset:offset + STORE_SLOT_SIZE]
+            key_digest, content, extension, size, last_used = STORE_RECORD.unpack(raw[:STORE_RECORD.size])
+            if key_digest == bytes(16):
+                self._free_slots.append(slot)
+                continue
+            if int.from_bytes(raw[-4:], 'little') != zlib.crc32(raw[:-4]):
+                # Torn by a crash mid-write
+                self._clear_slot(slot)
+                continue
+            records.append((last_used, slot, key_digest, content, extension.rstrip(b'\0').decode(), size))
+        for last_used, slot, key_digest, content, extension, size in sorted(records):
+            if key_digest in self._entries:
+                self._clear_slot(self._release(key_digest))
+            self._add(key_digest, slot, content, extension, size)
+        self._free_slots.sort(reverse=True)
+        logger.info(f"Audio store at {self.directory}: {len(self._entries)} clips, {self.current_bytes} bytes")
+
+    def _offset(self, slot):
+        return len(STORE_INDEX_MAGIC) + slot * STORE_SLOT_SIZE
+
+    def _write_slot(self, slot, key_digest, content, extension, size, last_used):
+        record = STORE_RECORD.pack(key_digest, content, extension.encode(), size, last_used)
+        offset = self._offset(slot)
+        self._index[offset:offset + STORE_SLOT_SIZE] = record + zlib.crc32(record).to_bytes(4, 'little')
+
+    def _path(self, content, extension, directory=None):
+        name = content.hex()
+        return os.path.join(directory or self.directory, name[:2], f'{name}.{extension}')
+
+    @staticmethod
+    def key_digest(key):
+        return hashlib.sha256(json.dumps(key, ensure_ascii=False).encode('utf-8')).digest()[:16]
+
+    def _add(self, key_digest, slot, content, extension, size):
+        self._entries[key_digest] = (slot, content, extension, size)
+        self._retain(content, size)
+
+    def _release(self, key_digest):
+        """Forget key_digest, returning its slot"""
+        slot, content, extension, size = self._entries.pop(key_digest)
+        self._unref(content, extension, size)
+        return slot
+
+    def _retain(self, content, size):
+        self._refs[content] = self._refs.get(content, 0) + 1
+        if self._refs[content] == 1:
+            self.current_bytes += size
+
+    def _unref(self, content, extension, size):
+        """Drop one key's use of a clip, deleting it once no key uses it"""
+        self._refs[content] -= 1
+        if not self._refs[content]:
+            del self._refs[content]
+            self.current_bytes -= size
+            try:
+                os.unlink(self._path(content, extension))
+            except FileNotFoundError:
+                pass
+
+    def _clear_slot(self, slot):
+        offset = self._offset(slot)
+        self._index[offset:offset + STORE_SLOT_SIZE] = bytes(STORE_SLOT_SIZE)
+        self._free_slots.append(slot)
+
+    def open(self, key, count_miss=True):
+        """Return (file, size, content digest) for the clip stored under key, or None on a miss"""
+        key_digest = self.key_digest(key)
+        with self._lock:
+            entry = self._entries.get(key_digest)
+            if entry is None:
+                self.misses += count_miss
+                return None
+            slot, content, extension, size = entry
+            try:
+                file = open(self._path(content, extension), 'rb')
+            except FileNotFoundError:
+                logger.warning(f"Audio store clip {content.hex()} is missing, dropping it")
+                self._clear_slot(self._release(key_digest))
+                self.misses += count_miss
+                return None
+            self._entries.move_to_end(key_digest)
+            self._write_slot(slot, key_digest, content, extension, size, time.time())
+            self.hits += 1
+        return file, size, content.hex()
+
+    def open_content(self, content, extension):
+        """Return (file, size) for the clip with this SHA-256 here or in a peer, or None"""
+        for directory in (self.directory, *self.peers):
+            try:
+                file = open(self._path(content, extension, directory), 'rb')
+            except FileNotFoundError:
+                continue
+            return file, os.fstat(file.fileno()).st_size
+        return None
+
+    def read(self, key):
+        """Return the bytes stored under key, or None on a miss"""
+        stored = self.open(key)
+        if stored is None:
+            return None
+        file, _, _ = stored
+        with file:
+            return file.read()
+
+    def put(self, key, data):
+        """Store data under key, evicting older clips to stay within budget"""
+        if len(data) > self.max_bytes:
+            return
+        extension = key[-1]
+        key_digest = self.key_digest(key)
+        content = hashlib.sha256(data).digest()
+        with self._lock:
+            exists = content in self._refs
+        try:
+            if not exists:
+                self._write_file(self._path(content, extension), data)
+        except OSError as e:
+            logger.warning(f"Could not write to the audio store: {e}")
+            return
+        
+        with self._lock:
+            previous = self._entries.get(key_digest)
+            if previous is not None:
+                # Retain the new clip before dropping the old one, in case they are the same file
+                slot = previous[0]
+                self._retain(content, len(data))
+                self._unref(*previous[1:])
+                self._entries[key_digest] = (slot, content, extension, len(data))
+                self._entries.move_to_end(key_digest)
+            else:
+                slot = self._free_slots.pop() if self._free_slots else self._grow()
+                self._add(key_digest, slot, content, extension, len(data))
+            self._write_slot(slot, key_digest, content, extension, len(data), time.time())
+            while self.current_bytes > self.max_bytes:
+                self._clear_slot(self._release(next(iter(self._entries))))
+                self.evictions += 1
+
+    def _write_file(self, path, data):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            os.unlink(temp_path)
+            raise
+
+    def _grow(self):
+        """Double the index, returning a free slot"""
+        capacity = self._capacity * 2
+        self._index.close()
+        self._file.truncate(self._offset(capacity))
+        self._index = mmap.mmap(self._file.fileno(), 0)
+        self._free_slots.extend(range(capacity - 1, self._capacity, -1))
+        slot = self._capacity
+        self._capacity = capacity
+        return slot
+
+    def close(self):
+        with self._lock:
+            self._index.flush()
+            self._index.close()
+            self._file.close()
+
+    def stats(self):
+        """Return a snapshot of the store counters"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.current_bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class SharedSynthesis:
+    """One upstream synthesis whose events are replayed to every subscriber.
+
+    Events are kept for the lifetime of the synthesis, so a subscriber
+    that joins late first catches up on everything received so far and
+    then follows along live. Must only be used on the engine loop.
+    """
+
+    def __init__(self):
+        self.events = []
+        self.finished = False
+        self.error = None
+        self._changed = asyncio.Event()
+
+    def publish(self, event):
+        self.events.append(event)
+        self._notify()
+
+    def finish(self, error=None):
+        self.finished = True
+        self.error = error
+        self._notify()
+
+    def _notify(self):
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def subscribe(self, on_chunk=None):
+        """Yield the audio chunks, calling on_chunk with every raw event"""
+        index = 0
+        while True:
+            while index < len(self.events):
+                event = self.events[index]
+                index += 1
+                if on_chunk is not None:
+                    on_chunk(event)
+                if event['type'] == 'audio':
+                    yield event['data']
+            if self.finished:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+
+class UpstreamClosed(ConnectionError):
+    """Raised when an upstream connection ends in the middle of a turn"""
+
+
+class UpstreamPool:
+    """Warm WebSocket connections to the Edge TTS service, reused across syntheses.
+
+    edge_tts.Communicate does a TLS and WebSocket handshake for every
+    synthesis. The service takes any number of request/response turns on
+    one connection, so here a connection goes back to the pool when its
+    turn ends cleanly and serves the next synthesis. Connections that
+    fail, are abandoned mid-turn or get too old are closed instead. When a
+    reused connection turns out to be closed by the server before any
+    audio arrived, the turn is retried once on a fresh connection.
+
+    Events are the same dicts edge_tts.Communicate.stream() yields. Must
+    only be used on the engine loop.
+    """
+
+    def __init__(self, size=UPSTREAM_POOL_SIZE, url=None, idle_timeout=UPSTREAM_IDLE_TIMEOUT,
+                 max_age=UPSTREAM_MAX_AGE):
+        self.size = size
+        self.url = url or WSS_URL
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self._idle = []
+        self._session = None
+        self._ssl = ssl.create_default_context(cafile=certifi.where())
+
+    async def stream(self, text, voice, rate_str, boundary='WordBoundary'):
+        """Yield audio and boundary events for text, like edge_tts.Communicate.stream()"""
+        config = TTSConfig(voice, rate_str or '+0%', '+0%', '+0Hz', boundary)
+        audio_bytes = 0
+        for part in split_text_by_byte_length(escape(remove_incompatible_characters(text)), 4096):
+            # Later parts start from zero, so shift their offsets past the audio so far
+            offset = audio_bytes * 8 * TICKS_PER_SECOND // AUDIO_BITRATE
+            received_audio = False
+            async for event in self._turn(config, part):
+                if event['type'] == 'audio':
+                    audio_bytes += len(event['data'])
+                    received_audio = True
+                else:
+                    event['offset'] += offset
+                yield event
+            if not received_audio:
+                raise RuntimeError('No audio was received from the TTS service')
+
+    async def _turn(self, config, ssml_text):
+        for attempt in range(2):
+            # Other idle connections may be just as stale, so the retry always reconnects
+            websocket, opened_at, reused = await self._acquire(fresh=attempt > 0)
+            received = False
+            finished = False
+            try:
+                await websocket.send_str(self._speech_config(config.boundary))
+                await websocket.send_str(ssml_headers_plus_data(connect_id(), date_to_string(),
+                                                                mkssml(config, ssml_text)))
+                async for event in self._receive(websocket):
+                    received = True
+                    yield event
+                finished = True
+                return
+            except (aiohttp.ClientError, ConnectionError) as e:
+                # A warm connection the server already dropped; nothing was sent downstream yet
+                if received or not reused or attempt:
+                    raise
+                logger.info(f"Reused upstream connection failed ({e}), reconnecting")
+            finally:
+                self._release(websocket, opened_at, finished)
+
+    async def _acquire(self, fresh=False):
+        now = time.monotonic()
+        while self._idle and not fresh:
+            websocket, opened_at, idle_since = self._idle.pop()
+            metrics.set('tts_upstream_connections_idle', len(self._idle))
+            if websocket.closed or now - idle_since > self.idle_timeout or now - opened_at > self.max_age:
+                await websocket.close()
+                continue
+            metrics.inc('tts_upstream_connections_total', outcome='reused')
+            return websocket, opened_at, True
+        
+        websocket = await self._connect()
+        metrics.inc('tts_upstream_connections_total', outcome='opened')
+        return websocket, now, False
+
+    async def _connect(self):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(trust_env=True, timeout=aiohttp.ClientTimeout(
+                total=None, sock_connect=10, sock_read=60))
+        
+        for attempt in range(2):
+            url = (f"{self.url}{'&' if '?' in self.url else '?'}ConnectionId={connect_id()}"
+                   f"&Sec-MS-GEC={DRM.generate_sec_ms_gec()}&Sec-MS-GEC-Version={SEC_MS_GEC_VERSION}")
+            try:
+                with metrics.timer('tts_stage_duration_seconds', stage='connect'):
+                    return await self._session.ws_connect(url, compress=15, ssl=self._ssl, receive_timeout=60,
+                                                          headers=DRM.headers_with_muid(WSS_HEADERS))
+            except aiohttp.ClientResponseError as e:
+                # 403 means our clock is off; edge_tts corrects the skew from the server date
+                if e.status != 403 or attempt:
+                    raise
+                DRM.handle_client_response_error(e)
+
+    def _release(self, websocket, opened_at, reusable):
+        if reusable and not websocket.closed and len(self._idle) < self.size:
+            self._idle.append((websocket, opened_at, time.monotonic()))
+            metrics.set('tts_upstream_connections_idle', len(self._idle))
+        elif not websocket.closed:
+            asyncio.ensure_future(websocket.close())
+
+    @staticmethod
+    def _speech_config(boundary):
+        word_boundary = 'true' if boundary == 'WordBoundary' else 'false'
+        sentence_boundary = 'false' if boundary == 'WordBoundary' else 'true'
+        return (f"X-Timestamp:{date_to_string()}\r\n"
+                "Content-Type:application/json; charset=utf-8\r\n"
+                "Path:speech.config\r\n\r\n"
+                '{"context":{"synthesis":{"audio":{"metadataoptions":{'
+                f'"sentenceBoundaryEnabled":"{sentence_boundary}","wordBoundaryEnabled":"{word_boundary}"'
+                '},"outputFormat":"audio-24khz-48kbitrate-mono-mp3"}}}}\r\n')
+
+    @staticmethod
+    async def _receive(websocket):
+        """Yield the events of one turn, returning once the service sends turn.end"""
+        while True:
+            message = await websocket.receive()
+            if message.type == aiohttp.WSMsgType.TEXT:
+                data = message.data.encode('utf-8')
+                headers, body = get_headers_and_data(data, data.find(b'\r\n\r\n'))
+                path = headers.get(b'Path')
+                if path == b'turn.end':
+                    return
+                if path == b'audio.metadata':
+                    for meta in json.loads(body)['Metadata']:
+                        if meta['Type'] in ('WordBoundary', 'SentenceBoundary'):
+                            yield {
+                                'type': meta['Type'],
+                                'offset': meta['Data']['Offset'],
+                                'duration': meta['Data']['Duration'],
+                                'text': unescape(meta['Data']['text']['Text']),
+                            }
+            elif message.type == aiohttp.WSMsgType.BINARY:
+                header_length = int.from_bytes(message.data[:2], 'big')
+                headers, body = get_headers_and_data(message.data, header_length)
+                if headers.get(b'Path') == b'audio' and body:
+                    yield {'type': 'audio', 'data': body}
+            elif message.type == aiohttp.WSMsgType.ERROR:
+                raise UpstreamClosed(f'Upstream connection failed: {message.data}')
+            else:
+                raise UpstreamClosed('Upstream closed the connection')
+
+    async def close(self):
+        """Close every idle connection and the HTTP session"""
+        idle, self._idle = self._idle, []
+        for websocket, _, _ in idle:
+            await websocket.close()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        metrics.set('tts_upstream_connections_idle', 0)
+
+
+class EventInbox:
+    """Events from concurrent upstream attempts, in arrival order
+
+    Items are kept in a deque rather than an asyncio.Queue so that a get
+    that times out can never swallow one.
+    """
+
+    def __init__(self):
+        self._items = deque()
+        self._arrived = asyncio.Event()
+
+    def put(self, index, item):
+        self._items.append((index, item))
+        self._arrived.set()
+
+    async def get(self, timeout=None):
+        """Return the next (attempt index, item), or None if timeout seconds pass first"""
+        while not self._items:
+            self._arrived.clear()
+            try:
+                await asyncio.wait_for(self._arrived.wait(), timeout)
+            except asyncio.TimeoutError:
+                return None
+        return self._items.popleft()
+
+
+class TTSEngine:
+    """Run all synthesis on one long-lived asyncio event loop.
+
+    The loop lives on a background thread and is shared by every request
+    thread, so many upstream syntheses can be in flight at once. A
+    semaphore caps how many of them run concurrently.
+    """
+
+    def __init__(self, max_concurrency=MAX_CONCURRENT_SYNTHESIS, cache=None,
+                 segment_workers=SEGMENT_WORKERS, segment_max_chars=SEGMENT_MAX_CHARS,
+                 batch_workers=BATCH_WORKERS, transcode_workers=TRANSCODE_WORKERS,
+                 upstream_pool_size=UPSTREAM_POOL_SIZE, upstream_url=None,
+                 first_chunk_timeout=FIRST_CHUNK_TIMEOUT, synthesis_timeout=SYNTHESIS_TIMEOUT,
+                 hedge_percentile=HEDGE_PERCENTILE, store=None):
+        self.max_concurrency = max_concurrency
+        self.first_chunk_timeout = first_chunk_timeout
+        self.synthesis_timeout = synthesis_timeout
+        self.hedge_percentile = hedge_percentile
+        self._first_chunk_times = deque(maxlen=HEDGE_WINDOW)
+        self.segment_workers = segment_workers
+        self.batch_workers = batch_workers
+        self.segment_max_chars = segment_max_chars
+        self.transcode_workers = transcode_workers
+        self.cache = cache if cache is not None else AudioCache()
+        # Optional AudioStore that keeps finished audio across restarts
+        self.store = store
+        # A pool size of 0 keeps the plain edge_tts.Communicate path
+        self.upstream = None
+        if upstream_pool_size and aiohttp is not None:
+            self.upstream = UpstreamPool(size=upstream_pool_size, url=upstream_url)
+        self.loop = None
+        self.semaphore = None
+        self._transcode_pool = None
+        self._syntheses = {}
+        self._transcodes = {}
+        # SHA-256 of published audio -> the cache key it is held under
+        self._audio_urls = OrderedDict()
+        self._audio_urls_lock = threading.Lock()
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        """Start the event loop thread if it is not running yet"""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self.loop = asyncio.new_event_loop()
+            ready = threading.Event()
+            self._thread = threading.Thread(target=self._run_loop, args=(ready,),
+                                            name='tts-event-loop', daemon=True)
+            self._thread.start()
+            ready.wait()
+
+    def _run_loop(self, ready):
+        asyncio.set_event_loop(self.loop)
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.loop.call_soon(ready.set)
+        try:
+            self.loop.run_forever()
+        finally:
+            # Cancel whatever is still running so the loop closes cleanly
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            if self.upstream is not None:
+                self.loop.run_until_complete(self.upstream.close())
+            # Let background writes to the disk store finish before it is closed
+            self.loop.run_until_complete(self.loop.shutdown_default_executor())
+            self.loop.close()
+
+    def stop(self):
+        """Stop the event loop thread and close the loop"""
+        with self._lock:
+            if self._thread is None:
+                return
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self._thread.join()
+            self._thread = None
+            self.loop = None
+            if self._transcode_pool is not None:
+                self._transcode_pool.shutdown(cancel_futures=True)
+                self._transcode_pool = None
+            if self.store is not None:
+                self.store.close()
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the shared loop and wait for its result"""
+        self.start()
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+    def iterate(self, agen):
+        """Consume an async generator on the shared loop from a request thread"""
+        self.start()
+        items = queue.Queue()
+        
+        async def pump():
+            try:
+                async for item in agen:
+                    items.put(('item', item))
+            except Exception as e:
+                items.put(('error', e))
+            finally:
+                await agen.aclose()
+                items.put(('end', None))
+        
+        future = asyncio.run_coroutine_threadsafe(pump(), self.loop)
+        try:
+            while True:
+                kind, item = items.get()
+                if kind == 'item':
+                    yield item
+                elif kind == 'error':
+                    raise item
+                else:
+                    return
+        finally:
+            future.cancel()
+
+    async def stream_segment(self, text, voice, rate_str, on_chunk=None):
+        """Yield audio chunks from one upstream synthesis as soon as they arrive
+
+        on_chunk, if given, is called with every raw edge_tts event,
+        including WordBoundary events, as it is received.
+
+        Audio must start within first_chunk_timeout and the synthesis
+        finish within synthesis_timeout seconds. With hedging on, if no
+        audio has arrived by the hedge_percentile of recent first-chunk
+        times and a synthesis slot is free, an identical second synthesis
+        is started and whichever produces audio first is used.
+        """
+        metrics.inc('tts_syntheses_queued')
+        try:
+            with metrics.timer('tts_stage_duration_seconds', stage='queue'):
+                await self.semaphore.acquire()
+        finally:
+            metrics.inc('tts_syntheses_queued', -1)
+        
+        metrics.inc('tts_syntheses_in_flight')
+        started = time.perf_counter()
+        first_chunk_deadline = started + self.first_chunk_timeout if self.first_chunk_timeout else None
+        deadline = started + self.synthesis_timeout if self.synthesis_timeout else None
+        hedge_delay = self._hedge_delay()
+        inbox = EventInbox()
+        attempts = [asyncio.ensure_future(self._run_attempt(0, text, voice, rate_str, inbox))]
+        slots = 1
+        early_events = {0: []}
+        failed = set()
+        winner = None
+        try:
+            while True:
+                wakeups = [deadline]
+                if winner is None:
+                    wakeups.append(first_chunk_deadline)
+                    if hedge_delay is not None and len(attempts) == 1:
+                        wakeups.append(started + hedge_delay)
+                wakeups = [wakeup for wakeup in wakeups if wakeup is not None]
+                timeout = max(0, min(wakeups) - time.perf_counter()) if wakeups else None
+                
+                received = await inbox.get(timeout)
+                if received is None:
+                    now = time.perf_counter()
+                    if deadline is not None and now >= deadline:
+                        raise TimeoutError(f'TTS service did not finish within {self.synthesis_timeout}s')
+                    if winner is None and first_chunk_deadline is not None and now >= first_chunk_deadline:
+                        raise TimeoutError(f'No audio from the TTS service within {self.first_chunk_timeout}s')
+                    if winner is None and hedge_delay is not None and len(attempts) == 1:
+                        # Only hedge with spare capacity, never by queueing behind other syntheses
+                        if not self.semaphore.locked():
+                            await self.semaphore.acquire()
+                            slots += 1
+                            early_events[1] = []
+                            attempts.append(asyncio.ensure_future(self._run_attempt(1, text, voice, rate_str, inbox)))
+                            metrics.inc('tts_hedged_requests_total', outcome='started')
+                        hedge_delay = None
+                    continue
+                
+                index, event = received
+                if winner is not None and index != winner:
+                    continue
+                if isinstance(event, Exception) or (event is None and winner is None):
+                    # While no attempt has produced audio, the other one may still succeed
+                    failed.add(index)
+                    if winner is None and len(failed) < len(attempts):
+                        continue
+                    raise event if event is not None else RuntimeError('No audio was received from the TTS service')
+                if event is None:
+                    break
+                
+                if winner is None:
+                    if event['type'] != 'audio':
+                        early_events[index].append(event)
+                        continue
+                    winner = index
+                    first_chunk_time = time.perf_counter() - started
+                    self._first_chunk_times.append(first_chunk_time)
+                    metrics.observe('tts_stage_duration_seconds', first_chunk_time, stage='first_chunk')
+                    if len(attempts) > 1:
+                        metrics.inc('tts_hedged_requests_total', outcome='won' if winner else 'lost')
+                        loser = attempts[1 - winner]
+                        loser.cancel()
+                        await asyncio.gather(loser, return_exceptions=True)
+                        self.semaphore.release()
+                        slots -= 1
+                    if on_chunk is not None:
+                        for early_event in early_events[winner]:
+                            on_chunk(early_event)
+                
+                if on_chunk is not None:
+                    on_chunk(event)
+                if event['type'] == 'audio':
+                    yield event['data']
+        except Exception as e:
+            metrics.inc('tts_upstream_errors_total', type=type(e).__name__)
+            raise
+        else:
+            metrics.observe('tts_stage_duration_seconds', time.perf_counter() - started, stage='upstream')
+            metrics.inc('tts_characters_total', len(text), voice=voice)
+            metrics.inc('tts_words_total', len(text.split()), voice=voice)
+        finally:
+            for attempt in attempts:
+                attempt.cancel()
+            await asyncio.gather(*attempts, return_exceptions=True)
+            metrics.inc('tts_syntheses_in_flight', -1)
+            for _ in range(slots):
+                self.semaphore.release()
+
+    async def _run_attempt(self, index, text, voice, rate_str, inbox):
+        """Run one upstream synthesis, feeding its events to inbox and ending with None or the error"""
+        if self.upstream is not None:
+            events = self.upstream.stream(text, voice, rate_str)
+        else:
+            events = create_communicate(text, voice, rate_str).stream()
+        try:
+            async for event in events:
+                inbox.put(index, event)
+            inbox.put(index, None)
+        except Exception as e:
+            inbox.put(index, e)
+        finally:
+            # Hands a finished connection back to the pool, or closes an abandoned one
+            await events.aclose()
+
+    def _hedge_delay(self):
+        """Seconds without audio after which to hedge, or None when hedging is off"""
+        if not self.hedge_percentile or len(self._first_chunk_times) < HEDGE_MIN_SAMPLES:
+            return None
+        times = sorted(self._first_chunk_times)
+        return times[min(len(times) - 1, int(self.hedge_percentile * len(times)))]
+
+    async def collect_segment(self, text, voice, rate_str, on_chunk=None):
+        """Gather the complete audio of one upstream synthesis in memory"""
+        chunks = [chunk async for chunk in self.stream_segment(text, voice, rate_str, on_chunk)]
+        if not chunks:
+            raise RuntimeError('No audio was received from the TTS service')
+        return b''.join(chunks)
+
+    async def stream(self, text, voice, rate, on_chunk=None):
+        """Yield the audio for text, synthesizing long input sentence by sentence.
+
+        Each sentence of a text longer than one segment is cached on its
+        own, so re-rendering an edited document only sends the changed
+        sentences upstream. The first sentence streams straight through
+        (unless cached) while the others are synthesized concurrently, at
+        most segment_workers at a time, and then yielded strictly in order.
+        """
+        rate_str = build_rate_string(rate)
+        if len(text) <= self.segment_max_chars:
+            async for chunk in self.stream_segment(text, voice, rate_str, on_chunk):
+                yield chunk
+            return
+        
+        segments = split_sentences(text, self.segment_max_chars)
+        workers = asyncio.Semaphore(self.segment_workers)
+        
+        async def render(segment, cached=None):
+            cached = cached or self.cached_segment(segment, voice, rate)
+            if cached is not None:
+                return cached
+            events = []
+            async with workers:
+                audio = await self.collect_segment(segment, voice, rate_str, events.append)
+            return self.cache_segment(segment, voice, rate, audio, events)
+        
+        first = self.cached_segment(segments[0], voice, rate)
+        if first is None:
+            await workers.acquire()
+        pending = [asyncio.ensure_future(render(segment)) for segment in segments[1:]]
+        if first is not None:
+            pending.insert(0, asyncio.ensure_future(render(segments[0], first)))
+        logger.info(f"Synthesizing {len(segments)} sentences with up to {self.segment_workers} workers")
+        try:
+            audio_bytes = 0
+            if first is None:
+                chunks = []
+                events = []
+                
+                def record(event):
+                    events.append(event)
+                    if on_chunk is not None:
+                        on_chunk(event)
+                
+                try:
+                    async for chunk in self.stream_segment(segments[0], voice, rate_str, record):
+                        chunks.append(chunk)
+                        audio_bytes += len(chunk)
+                        yield chunk
+                finally:
+                    workers.release()
+                self.cache_segment(segments[0], voice, rate, b''.join(chunks), events)
+            for task in pending:
+                audio, events = await task
+                if on_chunk is not None:
+                    # Replay the sentence's events in order, timed from the start of the whole text
+                    offset = audio_bytes * 8 * TICKS_PER_SECOND // AUDIO_BITRATE
+                    for event in events:
+                        on_chunk({**event, 'offset': event['offset'] + offset})
+                    on_chunk({'type': 'audio', 'data': audio})
+                audio_bytes += len(audio)
+                yield audio
+        finally:
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    def cached_segment(self, text, voice, rate):
+        """Return (audio, events) for a sentence synthesized before, or None"""
+        # Counted in tts_segment_cache_total rather than the whole-request cache counters
+        entry = self.cache.get(make_cache_key(text, voice, rate, 'segment'), count_miss=False, count_hit=False)
+        metrics.inc('tts_segment_cache_total', outcome='miss' if entry is None else 'hit')
+        if entry is None:
+            return None
+        return unpack_entry(entry)
+
+    def cache_segment(self, text, voice, rate, audio, events):
+        """Cache a sentence's audio with its boundary events, returning (audio, events)"""
+        events = [event for event in events if event['type'] != 'audio']
+        self.cache.put(make_cache_key(text, voice, rate, 'segment'), pack_entry(audio, events))
+        return audio, events
+
+    async def shared_stream(self, text, voice, rate, on_chunk=None):
+        """Yield the MP3 for text, attaching to an identical synthesis already in flight
+
+        Concurrent requests with the same cache key share one upstream
+        synthesis instead of each opening their own. The synthesis runs
+        to completion and is cached even if every subscriber goes away.
+        """
+        key = make_cache_key(text, voice, rate, 'mp3')
+        synthesis = self._syntheses.get(key)
+        if synthesis is None:
+            synthesis = self._syntheses[key] = SharedSynthesis()
+            asyncio.ensure_future(self._produce(key, synthesis, text, voice, rate))
+        else:
+            metrics.inc('tts_coalesced_requests_total', stage='synthesis')
+        async for chunk in synthesis.subscribe(on_chunk):
+            yield chunk
+
+    async def _produce(self, key, synthesis, text, voice, rate):
+        words = []
+        
+        def publish_event(event):
+            # Audio is published from the stream itself, which keeps segments in order
+            if event['type'] != 'audio':
+                synthesis.publish(event)
+            if event['type'] == 'WordBoundary':
+                words.append(word_timing(event))
+        
+        try:
+            chunks = []
+            async for chunk in self.stream(text, voice, rate, on_chunk=publish_event):
+                chunks.append(chunk)
+                synthesis.publish({'type': 'audio', 'data': chunk})
+            if not chunks:
+                raise RuntimeError('No audio was received from the TTS service')
+            # The timings came from the same synthesis, so they are cached in one entry with the audio
+            self.remember(key, pack_entry(b''.join(chunks), words))
+            synthesis.finish()
+        except Exception as e:
+            synthesis.finish(e)
+        finally:
+            del self._syntheses[key]
+
+    async def load(self, key):
+        """Return the cached data for key from memory or, failing that, the disk store"""
+        data = self.cache.get(key)
+        if data is None and self.store is not None:
+            data = await asyncio.get_running_loop().run_in_executor(None, self.store.read, key)
+            if data is not None:
+                self.cache.put(key, data)
+        return data
+
+    def remember(self, key, data):
+        """Cache data in memory and write it to the disk store in the background"""
+        self.cache.put(key, data)
+        if self.store is not None:
+            self.loop.run_in_executor(None, self.store.put, key, data)
+
+    def get_audio(self, text, voice, rate, audio_format):
+        """Return (audio, cached) for a request, going upstream only on a cache miss"""
+        # Hits skip the hop to the event loop; render() counts the miss
+        cache_key = make_cache_key(text, voice, rate, audio_format)
+        entry = self.cache.get(cache_key, count_miss=False)
+        if entry is not None:
+            return entry_audio(cache_key, entry), True
+        return self.run(self.render(text, voice, rate, audio_format))
+
+    def publish(self, key, audio_bytes):
+        """Return the immutable /audio/ URL serving audio_bytes, cached under key
+
+        The URL names the cache entry, which for MP3 includes the word
+        timings, so it is None if the entry is gone or holds other audio.
+        """
+        # The request that produced the audio has counted its lookup already
+        entry = self.cache.get(key, count_miss=False, count_hit=False)
+        if entry is None or entry_audio(key, entry) != audio_bytes:
+            return None
+        digest = hashlib.sha256(entry).hexdigest()
+        with self._audio_urls_lock:
+            self._audio_urls[digest] = key
+            self._audio_urls.move_to_end(digest)
+            while len(self._audio_urls) > AUDIO_URL_ENTRIES:
+                self._audio_urls.popitem(last=False)
+        return f'/audio/{digest}.{key[-1]}'
+
+    def open_audio(self, digest, audio_format):
+        """Return (file, size, offset) for the audio of the entry with this SHA-256, or None once it is gone"""
+        if self.store is not None:
+            stored = self.store.open_content(bytes.fromhex(digest), audio_format)
+            if stored is not None:
+                file, size = stored
+                offset = audio_offset(audio_format, file)
+                return file, size - offset, offset
+        with self._audio_urls_lock:
+            key = self._audio_urls.get(digest)
+        entry = self.cache.get(key) if key is not None and key[-1] == audio_format else None
+        # The key may have been synthesized again since, into different bytes
+        if entry is None or hashlib.sha256(entry).hexdigest() != digest:
+            return None
+        audio_bytes = entry_audio(key, entry)
+        return io.BytesIO(audio_bytes), len(audio_bytes), 0
+
+    def get_words(self, text, voice, rate):
+        """Return the word timings for text, going upstream only if they aren't cached"""
+        entry = self.cache.get(make_cache_key(text, voice, rate, 'mp3'), count_miss=False)
+        if entry is not None:
+            return unpack_entry(entry)[1]
+        return self.run(self.render_words(text, voice, rate))
+
+    async def render_words(self, text, voice, rate):
+        """Collect word timings from a (shared) synthesis, which caches its MP3 as well"""
+        entry = await self.load(make_cache_key(text, voice, rate, 'mp3'))
+        if entry is not None:
+            return unpack_entry(entry)[1]
+        words = []
+        
+        def collect(event):
+            if event['type'] == 'WordBoundary':
+                words.append(word_timing(event))
+        
+        async for _ in self.shared_stream(text, voice, rate, on_chunk=collect):
+            pass
+        return words
+
+    async def render(self, text, voice, rate, audio_format, on_chunk=None):
+        """Produce audio in the requested format, reusing cached work at every stage
+
+        Upstream always delivers MP3. Other formats are transcoded from the
+        (cached) MP3 in a worker process and cached per format, so each
+        conversion happens only once.
+        """
+        cache_key = make_cache_key(text, voice, rate, audio_format)
+        entry = await self.load(cache_key)
+        if entry is not None:
+            return entry_audio(cache_key, entry), True
+        
+        mp3_key = make_cache_key(text, voice, rate, 'mp3')
+        entry = await self.load(mp3_key) if audio_format != 'mp3' else None
+        if entry is not None:
+            mp3_bytes = entry_audio(mp3_key, entry)
+        else:
+            mp3_bytes = b''.join([chunk async for chunk in self.shared_stream(text, voice, rate, on_chunk)])
+        if audio_format == 'mp3':
+            return mp3_bytes, False
+        
+        transcode = self._transcodes.get(cache_key)
+        if transcode is None:
+            transcode = self._transcodes[cache_key] = asyncio.ensure_future(self.transcode(mp3_bytes, audio_format))
+            transcode.add_done_callback(lambda _: self._transcodes.pop(cache_key, None))
+            audio_bytes = await asyncio.shield(transcode)
+            self.remember(cache_key, audio_bytes)
+        else:
+            metrics.inc('tts_coalesced_requests_total', stage='transcode')
+            audio_bytes = await asyncio.shield(transcode)
+        return audio_bytes, False
+
+    async def transcode(self, mp3_bytes, audio_format):
+        """Run the registered encoder for audio_format in the process pool"""
+        if self._transcode_pool is None:
+            # Forking from a threaded server copies locks other threads may be holding
+            self._transcode_pool = ProcessPoolExecutor(max_workers=self.transcode_workers,
+                                                       mp_context=multiprocessing.get_context('forkserver'))
+        encoder = ENCODERS[audio_format]
+        with metrics.timer('tts_stage_duration_seconds', stage='transcode'):
+            return await self.loop.run_in_executor(self._transcode_pool, encoder, mp3_bytes, audio_format)
+
+    async def run_batch(self, jobs):
+        """Render many jobs concurrently and yield each result as it finishes
+
+        Results are dicts carrying the job index and either the raw audio
+        or the error for that job; one failing job never aborts the rest.
+        """
+        workers = asyncio.Semaphore(self.batch_workers)
+        
+        async def run_job(index, job):
+            async with workers:
+                try:
+                    text, voice, rate, audio_format = parse_tts_request(job)
+                    audio_bytes, cached = await self.render(text, voice, rate, audio_format)
+                except Exception as e:
+                    return {'index': index, 'success': False, 'error': str(e)}
+                return {
+                    'index': index,
+                    'success': True,
+                    'audio': audio_bytes,
+                    'format': audio_format,
+                    'voice': voice,
+                    'cached': cached,
+                }
+        
+        tasks = [asyncio.ensure_future(run_job(index, job)) for index, job in enumerate(jobs)]
+        try:
+            for next_done in asyncio.as_completed(tasks):
+                yield await next_done
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+
+class Overloaded(Exception):
+    """Raised when admission control turns a request away"""
+
+    def __init__(self, message, retry_after):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Tokens refilled at rate per second up to burst"""
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def level(self, now):
+        """Return how many tokens the bucket would hold at now"""
+        return min(self.burst, self.tokens + (now - self.updated) * self.rate)
+
+    def take(self, amount, now):
+        """Take amount tokens and return 0, or return the seconds until they are available
+
+        Amounts larger than the whole burst go through once the bucket is
+        full and leave it in debt, so they are slowed down but never
+        refused forever.
+        """
+        self.tokens = self.level(now)
+        self.updated = now
+        needed = min(amount, self.burst)
+        if self.tokens < needed:
+            return (needed - self.tokens) / self.rate
+        self.tokens -= amount
+        return 0
+
+
+class AdmissionController:
+    """Bound the synthesis requests in flight and each client's character rate.
+
+    At most max_in_flight requests run at once and at most max_waiting
+    more wait, each for no longer than wait_timeout seconds, for a free
+    slot. Every client also has a token bucket of characters refilled at
+    chars_per_second. Requests over any limit fail fast with Overloaded
+    instead of queueing without bound.
+    """
+
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT_REQUESTS, max_waiting=MAX_WAITING_REQUESTS,
+                 wait_timeout=ADMISSION_TIMEOUT, chars_per_second=CLIENT_CHARS_PER_SECOND,
+                 burst_chars=CLIENT_BURST_CHARS):
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.chars_per_second = chars_per_second
+        self.burst_chars = burst_chars
+        self.in_flight = 0
+        self.waiting = 0
+        self._hold_time = 1.0
+        self._buckets = OrderedDict()
+        self._condition = threading.Condition()
+        self._buckets_lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        """Hold an in-flight slot for the with-block, waiting in the bounded queue if needed"""
+        if not self.max_in_flight:
+            yield
+            return
+        
+        with self._condition:
+            if self.in_flight >= self.max_in_flight:
+                self._wait_for_slot()
+            self.in_flight += 1
+        entered_at = time.monotonic()
+        try:
+            yield
+        finally:
+            with self._condition:
+                self.in_flight -= 1
+                # Moving average of how long a slot is held, for Retry-After hints
+                self._hold_time += 0.2 * (time.monotonic() - entered_at - self._hold_time)
+                self._condition.notify()
+
+    def _wait_for_slot(self):
+        if self.waiting >= self.max_waiting:
+            metrics.inc('tts_admission_rejected_total', reason='queue_full')
+            raise Overloaded('Server is busy, try again later', self._retry_after())
+        
+        self.waiting += 1
+        metrics.inc('tts_admission_waiting')
+        deadline = time.monotonic() + self.wait_timeout
+        try:
+            with metrics.timer('tts_stage_duration_seconds', stage='admission'):
+                while self.in_flight >= self.max_in_flight:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        metrics.inc('tts_admission_rejected_total', reason='timeout')
+                        raise Overloaded('Timed out waiting for a free synthesis slot', self._retry_after())
+                    self._condition.wait(remaining)
+        finally:
+            self.waiting -= 1
+            metrics.inc('tts_admission_waiting', -1)
+
+    def _retry_after(self):
+        # Time for the slots to turn over often enough to serve everyone waiting
+        return self._hold_time * (self.waiting + 1) / self.max_in_flight
+
+    def charge(self, client, chars):
+        """Take chars from client's token bucket, raising Overloaded if it is empty"""
+        if not self.chars_per_second:
+            return
+        
+        now = time.monotonic()
+        with self._buckets_lock:
+            bucket = self._buckets.pop(client, None)
+            if bucket is None:
+                bucket = TokenBucket(self.chars_per_second, self.burst_chars, now)
+            self._buckets[client] = bucket
+            wait = bucket.take(chars, now)
+            self._prune(now)
+        if wait:
+            metrics.inc('tts_admission_rejected_total', reason='rate')
+            raise Overloaded(f'Character rate limit exceeded ({self.chars_per_second} characters per second)', wait)
+
+    def _prune(self, now):
+        # A bucket that has refilled completely is no different from a new one
+        while self._buckets:
+            client, bucket = next(iter(self._buckets.items()))
+            if bucket.level(now) < bucket.burst:
+                break
+            del self._buckets[client]
+
+
+class JobQueueFull(Exception):
+    """Raised when the job queue cannot take another job"""
+
+
+class SynthesisJob:
+    """State and progress of one asynchronous synthesis job.
+
+    Workers update the job from the event loop thread while request
+    threads read it, so every change bumps a version under a condition
+    variable that event subscribers can wait on.
+    """
+
+    def __init__(self, text, voice, rate, audio_format, id_prefix=''):
+        self.id = id_prefix + uuid.uuid4().hex
+        self.text = text
+        self.voice = voice
+        self.rate = rate
+        self.audio_format = audio_format
+        self.speakable_chars = max(len(''.join(text.split())), 1)
+        self.status = 'queued'
+        self.bytes_received = 0
+        self.boundaries_received = 0
+        self.chars_spoken = 0
+        self.audio = None
+        self.cached = False
+        self.error = None
+        self.submitted_at = time.monotonic()
+        self.finished_at = None
+        self.version = 0
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.status in ('done', 'failed')
+
+    def _update(self, **fields):
+        with self._changed:
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.version += 1
+            self._changed.notify_all()
+
+    def start(self):
+        self._update(status='running')
+
+    def record_chunk(self, chunk):
+        """Account for one raw edge_tts event received from upstream"""
+        if chunk['type'] == 'audio':
+            self._update(bytes_received=self.bytes_received + len(chunk['data']))
+        elif 'Boundary' in chunk['type']:
+            self._update(boundaries_received=self.boundaries_received + 1,
+                         chars_spoken=self.chars_spoken + len(chunk.get('text', '')))
+
+    def finish(self, audio, cached):
+        self._update(status='done', audio=audio, cached=cached, bytes_received=len(audio),
+                     chars_spoken=self.speakable_chars, finished_at=time.monotonic())
+
+    def fail(self, error):
+        self._update(status='failed', error=error, finished_at=time.monotonic())
+
+    def percent(self):
+        """Estimate completion from how much of the text has been spoken"""
+        if self.status == 'done':
+            return 100
+        if self.status == 'queued':
+            return 5
+        spoken = min(self.chars_spoken / self.speakable_chars, 1.0)
+        return 10 + int(spoken * 85)
+
+    def to_dict(self):
+        with self._changed:
+            info = {
+                'id': self.id,
+                'status': self.status,
+                'voice': self.voice,
+                'format': self.audio_format,
+                'progress': {
+                    'percent': self.percent(),
+                    'bytes': self.bytes_received,
+                    'boundaries': self.boundaries_received,
+                },
+            }
+            if self.status == 'done':
+                info['cached'] = self.cached
+                info['audio_url'] = f'/jobs/{self.id}/audio'
+            if self.error:
+                info['error'] = self.error
+            return info
+
+    def wait_for_change(self, seen_version, timeout):
+        """Block until the job changes past seen_version, or timeout expires"""
+        with self._changed:
+            self._changed.wait_for(lambda: self.version != seen_version, timeout)
+            return self.version
+
+
+class JobManager:
+    """Queue synthesis jobs and drain them with a worker pool on the engine loop"""
+
+    def __init__(self, engine, workers=JOB_WORKERS, max_queued=MAX_QUEUED_JOBS,
+                 retention=JOB_RETENTION, id_prefix=''):
+        self.engine = engine
+        self.id_prefix = id_prefix
+        self.workers = workers
+        self.max_queued = max_queued
+        self.retention = retention
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._queue = None
+        self._worker_tasks = []
+
+    def start(self):
+        """Start the worker tasks on the engine loop"""
+        if self._queue is None:
+            self.engine.run(self._start_workers())
+
+    async def _start_workers(self):
+        self._queue = asyncio.Queue()
+        self._worker_tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                metrics.observe('tts_stage_duration_seconds', time.monotonic() - job.submitted_at, stage='job_queue')
+                job.start()
+                audio, cached = await self.engine.render(job.text, job.voice, job.rate,
+                                                         job.audio_format, job.record_chunk)
+            except Exception as e:
+                logger.error(f"Job {job.id} failed: {e}")
+                job.fail(str(e))
+            else:
+                job.finish(audio, cached)
+                logger.info(f"Job {job.id} finished: {len(audio)} bytes")
+            finally:
+                self._queue.task_done()
+
+    def submit(self, text, voice, rate, audio_format):
+        """Queue a new job and return it without waiting for synthesis"""
+        self.start()
+        job = SynthesisJob(text, voice, rate, audio_format, self.id_prefix)
+        with self._lock:
+            self._prune()
+            queued = sum(1 for existing in self._jobs.values() if existing.status == 'queued')
+            if queued >= self.max_queued:
+                raise JobQueueFull(f'Job queue is full ({self.max_queued} jobs waiting)')
+            self._jobs[job.id] = job
+        self.engine.loop.call_soon_threadsafe(self._queue.put_nowait, job)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def queued_count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status == 'queued')
+
+    def active_count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if job.status in ('queued', 'running'))
+
+    def _prune(self):
+        """Forget finished jobs once their retention period is over"""
+        cutoff = time.monotonic() - self.retention
+        expired = [job_id for job_id, job in self._jobs.items()
+                   if job.finished_at is not None and job.finished_at < cutoff]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+# Paragraphs are separated by blank lines; sentences end with English or
+# Arabic terminal punctuation (. ! ? … and the Arabic ؟ ؛); clauses break
+# at commas, including the Arabic comma ،
+PARAGRAPH_BREAK_RE = re.compile(r'\n\s*\n')
+SENTENCE_BREAK_RE = re.compile(r'(?<=[.!?…؟؛])\s+')
+CLAUSE_BREAK_RE = re.compile(r'(?<=[,،;:])\s+')
+WHITESPACE_RE = re.compile(r'\s+')
+
+def split_sentences(text, max_chars=SEGMENT_MAX_CHARS):
+    """Split text into sentences of at most max_chars
+
+    Sentences never span paragraphs. Only sentences longer than max_chars
+    are broken further, at clause punctuation, then at spaces, and the
+    pieces packed back together up to max_chars. A sentence splits the
+    same way wherever it appears, so it can be cached on its own.
+    """
+    sentences = []
+    for paragraph in PARAGRAPH_BREAK_RE.split(text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        for sentence in SENTENCE_BREAK_RE.split(paragraph):
+            sentences.extend(pack_pieces(split_oversized(sentence, max_chars), max_chars))
+    return sentences or [text]
+
+def pack_pieces(pieces, max_chars):
+    """Join consecutive pieces of one sentence back together while they fit in max_chars"""
+    packed = []
+    for piece in pieces:
+        if packed and len(packed[-1]) + 1 + len(piece) <= max_chars:
+            packed[-1] += ' ' + piece
+        else:
+            packed.append(piece)
+    return packed
+
+def split_oversized(sentence, max_chars):
+    """Break a sentence longer than max_chars at clause breaks, then spaces"""
+    if len(sentence) <= max_chars:
+        return [sentence]
+    for pattern in (CLAUSE_BREAK_RE, WHITESPACE_RE):
+        parts = [part for part in pattern.split(sentence) if part]
+        if len(parts) > 1:
+            return [piece for part in parts for piece in split_oversized(part, max_chars)]
+    return [sentence[i:i + max_chars] for i in range(0, len(sentence), max_chars)]
+
+
+def build_rate_string(rate):
+    """Turn a percentage like 20 or -10 into the '+20%' form edge_tts expects"""
+    if rate == 0:
+        return None
+    if rate > 0:
+        return f"+{rate}%"
+    return f"{rate}%"
+
+# Every format the API accepts, with the Content-Type it is served as
+AUDIO_CONTENT_TYPES = {
+    'mp3': 'audio/mpeg',
+    'wav': 'audio/wav',
+    'ogg': 'audio/ogg',
+}
+
+# Encoders turn the MP3 delivered by edge_tts into another format. They run
+# in a worker process, so they must be picklable module-level callables
+# taking (mp3_bytes, audio_format) and returning the encoded bytes.
+ENCODERS = {}
+
+FFMPEG_OUTPUT_ARGS = {
+    'wav': ['-f', 'wav', '-acodec', 'pcm_s16le'],
+    'ogg': ['-f', 'ogg', '-acodec', 'libvorbis', '-q:a', '4'],
+}
+
+def register_encoder(audio_format, encoder):
+    """Install the encoder used to produce audio_format from MP3"""
+    ENCODERS[audio_format] = encoder
+
+def ffmpeg_encode(mp3_bytes, audio_format):
+    """Transcode MP3 bytes with the ffmpeg command line tool"""
+    command = ['ffmpeg', '-hide_banner', '-loglevel', 'error', '-f', 'mp3', '-i', 'pipe:0',
+               *FFMPEG_OUTPUT_ARGS[audio_format], 'pipe:1']
+    result = subprocess.run(command, input=mp3_bytes, capture_output=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"ffmpeg failed to encode {audio_format}: {result.stderr.decode(errors='replace').strip()}")
+    return result.stdout
+
+if shutil.which('ffmpeg'):
+    for _format in FFMPEG_OUTPUT_ARGS:
+        register_encoder(_format, ffmpeg_encode)
+
+def resolve_format(audio_format):
+    """Return the format that will actually be produced for a requested one"""
+    if audio_format not in AUDIO_CONTENT_TYPES:
+        raise ValueError(f"Unsupported format: {audio_format} (choose from {', '.join(AUDIO_CONTENT_TYPES)})")
+    if audio_format != 'mp3' and audio_format not in ENCODERS:
+        logger.warning(f"No encoder installed for {audio_format.upper()}, serving MP3 instead")
+        return 'mp3'
+    return audio_format
+
+def create_communicate(text, voice, rate_str=None):
+    """Create an Edge TTS communicate object for one synthesis, with word boundaries"""
+    options = {'rate': rate_str} if rate_str else {}
+    try:
+        return edge_tts.Communicate(text, voice, boundary='WordBoundary', **options)
+    except TypeError:
+        # edge_tts before 7.0 has no boundary option and always sends word boundaries
+        return edge_tts.Communicate(text, voice, **options)
+
+# Invisible characters that never change what is spoken: zero-width space,
+# zero-width joiner, word joiner and the byte order mark. The zero-width
+# non-joiner is kept because it separates morphemes in Persian.
+INVISIBLE_CHARS_RE = re.compile('[\u200b\u200d\u2060\ufeff]')
+TATWEEL_RE = re.compile('\u0640+')
+PARAGRAPH_WHITESPACE_RE = re.compile(r'\s*\n\s*\n\s*')
+RATE_RE = re.compile(r'^([+-]?\d+)\s*%?$')
+
+def canonicalize_text(text):
+    """Rewrite text into the canonical form it is keyed and synthesized as
+
+    The rules only remove differences that cannot change the audio:
+
+    1. Unicode is normalized to NFC, so composed and decomposed accents match.
+    2. Zero-width spaces and joiners, word joiners and BOMs are removed.
+    3. Arabic tatweel (kashida), which only stretches letters, is removed.
+    4. Whitespace runs spanning a blank line become one paragraph break
+       (which split_sentences honours); all other runs become one space.
+    5. Leading and trailing whitespace is stripped.
+    """
+    text = unicodedata.normalize('NFC', text)
+    text = INVISIBLE_CHARS_RE.sub('', text)
+    text = TATWEEL_RE.sub('', text)
+    paragraphs = PARAGRAPH_WHITESPACE_RE.split(text.strip())
+    return '\n\n'.join(WHITESPACE_RE.sub(' ', paragraph) for paragraph in paragraphs)
+
+def canonicalize_rate(rate):
+    """Turn 0, 10.0, '10', '+10%' and the like into a whole percentage"""
+    if isinstance(rate, bool):
+        raise ValueError(f'Invalid rate: {rate!r}')
+    if isinstance(rate, str):
+        match = RATE_RE.match(rate.strip())
+        if match is None:
+            raise ValueError(f'Invalid rate: {rate!r} (use a percentage such as 10 or "+10%")')
+        return int(match.group(1))
+    if isinstance(rate, (int, float)) and rate == int(rate):
+        return int(rate)
+    raise ValueError(f'Invalid rate: {rate!r} (use a whole percentage)')
+
+def make_cache_key(text, voice, rate, audio_format):
+    """Build the key audio is cached and coalesced under
+
+    Callers pass the canonical values from parse_tts_request, so requests
+    that only differ in spelling share one key.
+    """
+    return (text, voice, rate, audio_format)
+
+def pack_entry(audio, metadata):
+    """Prefix audio with JSON metadata, so the two are cached and evicted as one entry"""
+    header = json.dumps(metadata).encode('utf-8')
+    return len(header).to_bytes(4, 'big') + header + audio
+
+def unpack_entry(entry):
+    """Split a pack_entry() entry into (audio, metadata)"""
+    header_length = int.from_bytes(entry[:4], 'big')
+    return entry[4 + header_length:], json.loads(entry[4:4 + header_length])
+
+def entry_audio(key, entry):
+    """Return the audio of the cache entry for key
+
+    MP3 entries carry the word timings of the synthesis that produced
+    them; transcoded formats are cached as plain audio.
+    """
+    return unpack_entry(entry)[0] if key[-1] == 'mp3' else entry
+
+def audio_offset(audio_format, file):
+    """Return where the audio starts in a stored clip file of audio_format"""
+    if audio_format != 'mp3':
+        return 0
+    file.seek(0)
+    return 4 + int.from_bytes(file.read(4), 'big')
+
+def parse_tts_request(data):
+    """Validate a /tts JSON body and return canonical (text, voice, rate, format)"""
+    if not isinstance(data, dict):
+        raise ValueError('Request must be a JSON object')
+    raw_text = data.get('text', '')
+    raw_voice = data.get('voice', 'en-US-AriaNeural')
+    raw_rate = data.get('rate', 0)
+    raw_format = data.get('format', 'mp3')
+    if not isinstance(raw_text, str) or not isinstance(raw_voice, str):
+        raise ValueError('text and voice must be strings')
+    
+    text = canonicalize_text(raw_text)
+    voice = raw_voice.strip()
+    rate = canonicalize_rate(raw_rate)
+    audio_format = str(raw_format).strip().lower()
+    for field, raw, canonical in (('text', raw_text.strip(), text), ('voice', raw_voice, voice),
+                                  ('rate', raw_rate, rate), ('format', raw_format, audio_format)):
+        if raw != canonical or type(raw) is not type(canonical):
+            metrics.inc('tts_canonicalized_requests_total', field=field)
+    
+    if not text:
+        raise ValueError('No text provided')
+    if len(text) > MAX_TEXT_LENGTH:
+        raise ValueError(f'Text too long (max {MAX_TEXT_LENGTH} characters)')
+    return text, voice, rate, resolve_format(audio_format)
+
+
+SUBTITLE_CONTENT_TYPES = {
+    'json': 'application/json',
+    'srt': 'application/x-subrip; charset=utf-8',
+    'vtt': 'text/vtt; charset=utf-8',
+}
+
+# Cues break after a sentence or before growing past one caption line
+SUBTITLE_MAX_CHARS = 42
+CUE_END_RE = re.compile(r'[.!?…؟]["\')\]]*$')
+
+def word_timing(event):
+    """Convert an edge_tts WordBoundary event into {text, start, end} in seconds"""
+    start = event['offset'] / TICKS_PER_SECOND
+    end = (event['offset'] + event['duration']) / TICKS_PER_SECOND
+    return {'text': event['text'], 'start': round(start, 3), 'end': round(end, 3)}
+
+def parse_subtitle_format(value):
+    """Validate a requested subtitle format, returning None when none was asked for"""
+    if value is None:
+        return None
+    subtitle_format = str(value).lower()
+    if subtitle_format not in SUBTITLE_CONTENT_TYPES:
+        raise ValueError(f"Unsupported subtitles format '{value}' "
+                         f"(choose from {', '.join(SUBTITLE_CONTENT_TYPES)})")
+    return subtitle_format
+
+def group_cues(words, max_chars=SUBTITLE_MAX_CHARS):
+    """Group word timings into (start, end, text) caption cues"""
+    cues = []
+    current = []
+    for word in words:
+        line = ' '.join(w['text'] for w in current + [word])
+        if current and (len(line) > max_chars or CUE_END_RE.search(current[-1]['text'])):
+            cues.append(current)
+            current = []
+        current.append(word)
+    if current:
+        cues.append(current)
+    return [(cue[0]['start'], cue[-1]['end'], ' '.join(w['text'] for w in cue)) for cue in cues]
+
+def format_timestamp(seconds, separator):
+    millis = int(round(seconds * 1000))
+    hours, millis = divmod(millis, 3600000)
+    minutes, millis = divmod(millis, 60000)
+    return f"{hours:02d}:{minutes:02d}:{millis // 1000:02d}{separator}{millis % 1000:03d}"
+
+def format_subtitles(words, subtitle_format):
+    """Render word timings as a JSON document, SRT or WebVTT"""
+    if subtitle_format == 'json':
+        return json.dumps({'words': words}, ensure_ascii=False)
+    lines = ['WEBVTT', ''] if subtitle_format == 'vtt' else []
+    separator = '.' if subtitle_format == 'vtt' else ','
+    for number, (start, end, text) in enumerate(group_cues(words), 1):
+        if subtitle_format == 'srt':
+            lines.append(str(number))
+        lines += [f"{format_timestamp(start, separator)} --> {format_timestamp(end, separator)}", text, '']
+    return '\n'.join(lines)
+
+
+AUDIO_PATH_RE = re.compile(rf"/audio/([0-9a-f]{{64}})\.({'|'.join(AUDIO_CONTENT_TYPES)})")
+
+def parse_range(header, size):
+    """Return the (start, end) bytes a single-range Range header asks for
+
+    None means the whole body should be sent: there was no usable header,
+    or it asked for several ranges. Raises ValueError when the range lies
+    entirely past the end of the body.
+    """
+    unit, _, spec = (header or '').partition('=')
+    if unit.strip().lower() != 'bytes' or ',' in spec:
+        return None
+    first, _, last = spec.strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            # A suffix range: the final bytes of the body
+            start = max(size - int(last), 0)
+            end = size - 1
+    except ValueError:
+        return None
+    if first and last and end < start:
+        # Syntactically invalid, so ignored like a missing header
+        return None
+    if start >= size:
+        raise ValueError('Range not satisfiable')
+    return start, min(end, size - 1)
+
+
+def parse_accept_encoding(header):
+    """Return the set of content codings a client accepts (q > 0)"""
+    accepted = set()
+    for item in (header or '').split(','):
+        coding, _, params = item.partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding.strip() and quality > 0:
+            accepted.add(coding.strip().lower())
+    return accepted
+
+
+class StaticAsset:
+    """A fixed response body, precompressed once with a strong ETag per variant"""
+
+    def __init__(self, body, content_type, compress=True):
+        self.content_type = content_type
+        digest = hashlib.sha256(body).hexdigest()[:32]
+        self.variants = {'identity': (body, f'"{digest}"')}
+        if not compress:
+            # Already-compressed media such as MP3 gains nothing from gzip
+            return
+        self.variants['gzip'] = (gzip.compress(body, compresslevel=9, mtime=0), f'"{digest}-gzip"')
+        if brotli is not None:
+            self.variants['br'] = (brotli.compress(body), f'"{digest}-br"')
+
+    def select(self, accept_encoding):
+        """Pick the best variant for an Accept-Encoding header: (coding, body, etag)"""
+        accepted = parse_accept_encoding(accept_encoding)
+        for coding in ('br', 'gzip'):
+            if coding in self.variants and coding in accepted:
+                return (coding, *self.variants[coding])
+        return ('identity', *self.variants['identity'])
+
+
+# The voices offered in the UI; only these have preview clips
+PREVIEW_VOICES = (
+    'en-US-AriaNeural', 'en-US-JennyNeural', 'en-US-GuyNeural', 'en-US-AndrewNeural',
+    'en-GB-SoniaNeural', 'en-GB-RyanNeural', 'en-AU-NatashaNeural', 'en-AU-WilliamNeural',
+    'ar-SA-ZariyahNeural', 'ar-SA-HamedNeural', 'ar-EG-SalmaNeural', 'ar-EG-ShakirNeural',
+)
+
+def voice_display_name(voice):
+    """The short name of a voice (Aria for en-US-AriaNeural), or the voice as given if it has another form"""
+    parts = voice.split('-')
+    if len(parts) < 3:
+        return voice
+    return parts[-1].replace('Neural', '')
+
+def preview_text(voice):
+    """The fixed sentence a voice reads for its preview"""
+    if voice.startswith('ar-'):
+        return "مرحباً! هذا اختبار لجودة الصوت مع Edge TTS."
+    voice_name = voice_display_name(voice)
+    return f"Hello! I'm {voice_name}. This is a preview of my premium voice quality."
 
-# Set up logging
-logging.basicConfig(level=logging.INFO)
-logger = logging.getLogger(__name__)
 
-class EdgeTTSHandler(SimpleHTTPRequestHandler):
-    def do_GET(self):
-        if self.path == '/' or self.path == '/index.html':
-            self.send_response(200)
-            self.send_header('Content-type', 'text/html; charset=utf-8')
-            self.send_header('Access-Control-Allow-Origin', '*')
-            self.end_headers()
-            
-            html = """<!DOCTYPE html>
+class PreviewStore:
+    """Voice preview clips, rendered once (at startup or on first use) and kept in memory"""
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._assets = {}
+
+    def get(self, voice):
+        """Return the preview StaticAsset for voice, rendering it if needed"""
+        if voice not in PREVIEW_VOICES:
+            raise KeyError(voice)
+        asset = self._assets.get(voice)
+        if asset is None:
+            audio, _ = self.engine.get_audio(preview_text(voice), voice, 0, 'mp3')
+            asset = self._assets[voice] = StaticAsset(audio, 'audio/mpeg', compress=False)
+        return asset
+
+    def prerender(self):
+        """Render every missing preview in the background on the engine loop"""
+        return asyncio.run_coroutine_threadsafe(self._render_all(), self.engine.loop)
+
+    async def _render_all(self):
+        voices = [voice for voice in PREVIEW_VOICES if voice not in self._assets]
+        results = await asyncio.gather(*(self.engine.render(preview_text(voice), voice, 0, 'mp3')
+                                         for voice in voices), return_exceptions=True)
+        for voice, result in zip(voices, results):
+            if isinstance(result, Exception):
+                logger.warning(f"Could not pre-render preview for {voice}: {result}")
+            else:
+                self._assets[voice] = StaticAsset(result[0], 'audio/mpeg', compress=False)
+        logger.info(f"🎧 Pre-rendered {len(self._assets)}/{len(PREVIEW_VOICES)} voice previews")
+
+
+INDEX_HTML = """<!DOCTYPE html>
 <html lang="en">
 <head>
     <meta charset="UTF-8">
@@ -556,7 +2553,14 @@ class EdgeTTSHandler(SimpleHTTPRequestHandler):
     </div>
 
     <script>
-        let currentAudioData = null;
+        // The finished clip, kept once as a Blob for downloads
+        let currentAudioBlob = null;
+        // Object URL the player is showing, released when replaced
+        let playbackUrl = null;
+        
+        // Clips generated in this browser are kept in IndexedDB, least recently used evicted first
+        const CLIP_CACHE_BYTES = 50 * 1024 * 1024;
+        let clipDatabase = null;
         
         const sampleTexts = {
             english: "Welcome to Edge TTS Pro! This advanced neural voice technology delivers crystal-clear, natural-sounding speech perfect for professional content.",
@@ -579,9 +2583,9 @@ class EdgeTTSHandler(SimpleHTTPRequestHandler):
             const counter = document.getElementById('charCount');
             counter.textContent = `${count} characters`;
             
-            if (count > 4500) {
+            if (count > 90000) {
                 counter.style.color = '#dc3545';
-            } else if (count > 4000) {
+            } else if (count > 80000) {
                 counter.style.color = '#ffc107';
             } else {
                 counter.style.color = '#666';
@@ -617,31 +2621,265 @@ class EdgeTTSHandler(SimpleHTTPRequestHandler):
             updateCharCount();
         }
         
+        let previewAudio = null;
+        
         async function previewVoice() {
+            // Previews are pre-rendered static clips the browser can cache
             const voice = document.getElementById('voice').value;
-            let sampleText;
+            if (previewAudio) {
+                previewAudio.pause();
+            }
+            previewAudio = new Audio(`/preview/${voice}.mp3`);
+            try {
+                await previewAudio.play();
+            } catch (error) {
+                showError('Could not play preview: ' + error.message);
+            }
+        }
+        
+        function audioMimeType(format) {
+            return format === 'mp3' ? 'audio/mpeg' : `audio/${format}`;
+        }
+        
+        function audioFormat(mimeType) {
+            return mimeType === 'audio/mpeg' ? 'mp3' : mimeType.split('/')[1];
+        }
+        
+        function setAudioSource(audioElement, source) {
+            // Object URLs pin their Blob or MediaSource until revoked
+            if (playbackUrl) {
+                URL.revokeObjectURL(playbackUrl);
+            }
+            playbackUrl = URL.createObjectURL(source);
+            audioElement.src = playbackUrl;
+        }
+        
+        async function responseError(response) {
+            const data = await response.json().catch(() => ({}));
+            return new Error(data.error || `HTTP error! status: ${response.status}`);
+        }
+        
+        function canStream(format) {
+            // Only MP3 is streamed by the server as it is synthesized
+            return format === 'mp3' && 'MediaSource' in window && MediaSource.isTypeSupported(audioMimeType('mp3'));
+        }
+        
+        function updateBuffer(sourceBuffer, action) {
+            // Run appendBuffer() or remove() and wait for the SourceBuffer to finish it
+            return new Promise((resolve, reject) => {
+                const finish = (error) => {
+                    sourceBuffer.removeEventListener('updateend', onEnd);
+                    sourceBuffer.removeEventListener('error', onError);
+                    if (error) {
+                        reject(error);
+                    } else {
+                        resolve();
+                    }
+                };
+                const onEnd = () => finish();
+                const onError = () => finish(new Error('The browser could not decode the audio'));
+                sourceBuffer.addEventListener('updateend', onEnd);
+                sourceBuffer.addEventListener('error', onError);
+                try {
+                    action();
+                } catch (error) {
+                    finish(error);
+                }
+            });
+        }
+        
+        async function appendChunk(audioElement, sourceBuffer, chunk) {
+            // Returns true if audio already played had to be dropped to make room
+            let trimmed = false;
+            while (true) {
+                try {
+                    await updateBuffer(sourceBuffer, () => sourceBuffer.appendBuffer(chunk));
+                    return trimmed;
+                } catch (error) {
+                    if (error.name !== 'QuotaExceededError') {
+                        throw error;
+                    }
+                }
+                const played = audioElement.currentTime - 10;
+                if (played > 0 && sourceBuffer.buffered.length && sourceBuffer.buffered.start(0) < played) {
+                    await updateBuffer(sourceBuffer, () => sourceBuffer.remove(0, played));
+                    trimmed = true;
+                } else {
+                    // Wait for playback to free up some of the buffer
+                    await new Promise(resolve => setTimeout(resolve, 1000));
+                }
+            }
+        }
+        
+        async function streamAudio(request, audioElement, onStart) {
+            // Play MP3 through MediaSource as it arrives and return the whole clip as a Blob
+            const response = await fetch('/tts/stream', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(request)
+            });
+            if (!response.ok) {
+                throw await responseError(response);
+            }
             
-            if (voice.startsWith('ar-')) {
-                sampleText = "مرحباً! هذا اختبار لجودة الصوت مع Edge TTS.";
-            } else {
-                const voiceName = voice.split('-')[2].replace('Neural', '');
-                sampleText = `Hello! I'm ${voiceName}. This is a preview of my premium voice quality.`;
+            const mediaSource = new MediaSource();
+            setAudioSource(audioElement, mediaSource);
+            await new Promise(resolve => mediaSource.addEventListener('sourceopen', resolve, { once: true }));
+            const sourceBuffer = mediaSource.addSourceBuffer(audioMimeType('mp3'));
+            sourceBuffer.mode = 'sequence';
+            
+            // Roughly 400 bytes of 48 kbit/s audio per character drives the progress bar
+            const expectedBytes = request.text.length * 400 / (1 + request.rate / 100);
+            const chunks = [];
+            let received = 0;
+            let trimmed = false;
+            const reader = response.body.getReader();
+            while (true) {
+                const { done, value } = await reader.read();
+                if (done) {
+                    break;
+                }
+                trimmed = await appendChunk(audioElement, sourceBuffer, value) || trimmed;
+                chunks.push(value);
+                received += value.length;
+                updateProgress(Math.min(95, Math.round(received / expectedBytes * 100)));
+                if (chunks.length === 1) {
+                    onStart();
+                }
+            }
+            mediaSource.endOfStream();
+            
+            const blob = new Blob(chunks, { type: audioMimeType('mp3') });
+            if (trimmed) {
+                // Played audio was dropped to make room, so switch to the whole clip to allow seeking back
+                const { currentTime, paused } = audioElement;
+                setAudioSource(audioElement, blob);
+                audioElement.addEventListener('loadedmetadata', () => {
+                    audioElement.currentTime = currentTime;
+                    if (!paused) {
+                        audioElement.play().catch(() => {});
+                    }
+                }, { once: true });
+            }
+            return blob;
+        }
+        
+        function idbResult(request) {
+            return new Promise((resolve, reject) => {
+                request.onsuccess = () => resolve(request.result);
+                request.onerror = () => reject(request.error);
+            });
+        }
+        
+        function openClipCache() {
+            if (!clipDatabase) {
+                const request = indexedDB.open('edge-tts', 1);
+                request.onupgradeneeded = () => {
+                    const clips = request.result.createObjectStore('clips', { keyPath: 'key' });
+                    clips.createIndex('lastUsed', 'lastUsed');
+                };
+                clipDatabase = idbResult(request);
+            }
+            return clipDatabase;
+        }
+        
+        function clipKey(request) {
+            return JSON.stringify([request.text, request.voice, request.rate, request.format]);
+        }
+        
+        async function getCachedClip(key) {
+            // Returns the cached Blob for key, marking it as recently used, or null
+            try {
+                const db = await openClipCache();
+                const clips = db.transaction('clips', 'readwrite').objectStore('clips');
+                const clip = await idbResult(clips.get(key));
+                if (!clip) {
+                    return null;
+                }
+                clip.lastUsed = Date.now();
+                clips.put(clip);
+                return clip.blob;
+            } catch (error) {
+                console.log('Clip cache unavailable:', error);
+                return null;
+            }
+        }
+        
+        async function cacheClip(key, blob) {
+            if (blob.size > CLIP_CACHE_BYTES) {
+                return;
+            }
+            try {
+                const db = await openClipCache();
+                const clips = db.transaction('clips', 'readwrite').objectStore('clips');
+                clips.put({ key: key, blob: blob, size: blob.size, lastUsed: Date.now() });
+                // Oldest first, so evict from the front until the cache fits its budget again
+                const all = await idbResult(clips.index('lastUsed').getAll());
+                let total = all.reduce((sum, clip) => sum + clip.size, 0);
+                for (const clip of all) {
+                    if (total <= CLIP_CACHE_BYTES) {
+                        break;
+                    }
+                    clips.delete(clip.key);
+                    total -= clip.size;
+                }
+            } catch (error) {
+                console.log('Could not cache clip:', error);
             }
+        }
+        
+        async function renderAudio(request, audioElement) {
+            // Formats that can't be streamed are rendered as a job, following its progress
+            const jobResponse = await fetch('/jobs', {
+                method: 'POST',
+                headers: { 'Content-Type': 'application/json' },
+                body: JSON.stringify(request)
+            });
             
-            const originalText = document.getElementById('text').value;
-            document.getElementById('text').value = sampleText;
+            const submitted = await jobResponse.json();
+            if (!submitted.success) {
+                throw new Error(submitted.error || `HTTP error! status: ${jobResponse.status}`);
+            }
             
-            await convert(true);
+            const job = await waitForJob(submitted.job);
             
-            document.getElementById('text').value = originalText;
-            updateCharCount();
+            const response = await fetch(`${job.audio_url}?response=binary`);
+            if (!response.ok) {
+                throw await responseError(response);
+            }
+            const blob = await response.blob();
+            setAudioSource(audioElement, blob);
+            return blob;
         }
         
         function updateProgress(percent) {
             document.getElementById('progressFill').style.width = percent + '%';
         }
         
-        async function convert(isPreview = false) {
+        function waitForJob(job) {
+            // Follow real server-side progress until the job is done
+            return new Promise((resolve, reject) => {
+                updateProgress(job.progress.percent);
+                const events = new EventSource(`/jobs/${job.id}/events`);
+                events.addEventListener('progress', (e) => {
+                    updateProgress(JSON.parse(e.data).progress.percent);
+                });
+                events.addEventListener('done', (e) => {
+                    events.close();
+                    resolve(JSON.parse(e.data));
+                });
+                events.addEventListener('failed', (e) => {
+                    events.close();
+                    reject(new Error(JSON.parse(e.data).error || 'Conversion failed'));
+                });
+                events.onerror = () => {
+                    events.close();
+                    reject(new Error('Lost connection to the server'));
+                };
+            });
+        }
+        
+        async function convert() {
             const text = document.getElementById('text').value.trim();
             const voice = document.getElementById('voice').value;
             const rate = parseInt(document.getElementById('rate').value);
@@ -652,8 +2890,8 @@ class EdgeTTSHandler(SimpleHTTPRequestHandler):
                 return;
             }
             
-            if (text.length > 5000) {
-                showError('Text is too long. Please limit to 5000 characters.');
+            if (text.length > 100000) {
+                showError('Text is too long. Please limit to 100000 characters.');
                 return;
             }
             
@@ -662,59 +2900,52 @@ class EdgeTTSHandler(SimpleHTTPRequestHandler):
             document.getElementById('convertBtn').disabled = true;
             document.getElementById('convertBtn').innerHTML = '<i class="fas fa-spinner fa-spin"></i> Converting...';
             
-            updateProgress(10);
+            updateProgress(0);
             
-            try {
-                updateProgress(30);
-                
-                const response = await fetch('/tts', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ 
-                        text: text, 
-                        voice: voice,
-                        rate: rate,
-                        format: format
-                    })
-                });
-                
-                updateProgress(60);
-                
-                if (!response.ok) {
-                    throw new Error(`HTTP error! status: ${response.status}`);
+            const request = { 
+                text: text, 
+                voice: voice,
+                rate: rate,
+                format: format
+            };
+            const audioElement = document.getElementById('audio');
+            currentAudioBlob = null;
+            document.getElementById('downloadBtn').style.display = 'none';
+            
+            audioElement.ondurationchange = () => {
+                // A stream's duration grows as it arrives and is unknown at first
+                if (isFinite(audioElement.duration)) {
+                    document.getElementById('audioDuration').textContent = `${Math.round(audioElement.duration)}s`;
                 }
-                
-                const data = await response.json();
-                
-                updateProgress(80);
-                
-                if (data.success) {
-                    const audioData = `data:audio/${format};base64,` + data.audio;
-                    const audioElement = document.getElementById('audio');
-                    audioElement.src = audioData;
-                    
-                    document.getElementById('usedVoice').textContent = voice.split('-')[2].replace('Neural', '');
-                    document.getElementById('wordCount').textContent = text.split(' ').length;
-                    
-                    audioElement.onloadedmetadata = () => {
-                        const duration = Math.round(audioElement.duration);
-                        document.getElementById('audioDuration').textContent = `${duration}s`;
-                    };
-                    
-                    document.getElementById('result').style.display = 'block';
-                    document.getElementById('downloadBtn').style.display = 'block';
-                    currentAudioData = data.audio;
-                    
-                    updateProgress(100);
-                    
-                    setTimeout(() => {
-                        audioElement.play().catch(e => {
-                            console.log('Auto-play prevented by browser');
-                        });
-                    }, 500);
+            };
+            
+            const showResult = () => {
+                document.getElementById('usedVoice').textContent = voice.split('-')[2].replace('Neural', '');
+                document.getElementById('wordCount').textContent = text.split(' ').length;
+                document.getElementById('result').style.display = 'block';
+                audioElement.play().catch(e => {
+                    console.log('Auto-play prevented by browser');
+                });
+            };
+            
+            try {
+                const key = clipKey(request);
+                currentAudioBlob = await getCachedClip(key);
+                if (currentAudioBlob) {
+                    // A repeat conversion never leaves the browser
+                    setAudioSource(audioElement, currentAudioBlob);
+                    showResult();
                 } else {
-                    showError('Error: ' + (data.error || 'Unknown error occurred'));
+                    if (canStream(format)) {
+                        currentAudioBlob = await streamAudio(request, audioElement, showResult);
+                    } else {
+                        currentAudioBlob = await renderAudio(request, audioElement);
+                        showResult();
+                    }
+                    cacheClip(key, currentAudioBlob);
                 }
+                document.getElementById('downloadBtn').style.display = 'block';
+                updateProgress(100);
             } catch (error) {
                 console.error('Conversion error:', error);
                 showError('Error: ' + error.message);
@@ -728,17 +2959,20 @@ class EdgeTTSHandler(SimpleHTTPRequestHandler):
         }
         
         function downloadAudio() {
-            if (currentAudioData) {
-                const format = document.getElementById('format').value;
+            if (currentAudioBlob) {
+                const format = audioFormat(currentAudioBlob.type);
                 const voice = document.getElementById('voice').value.split('-')[2].replace('Neural', '');
                 const timestamp = new Date().toISOString().slice(0, 10);
                 
+                const url = URL.createObjectURL(currentAudioBlob);
                 const link = document.createElement('a');
-                link.href = `data:audio/${format};base64,` + currentAudioData;
+                link.href = url;
                 link.download = `EdgeTTS-${voice}-${timestamp}.${format}`;
                 document.body.appendChild(link);
                 link.click();
                 document.body.removeChild(link);
+                // The download has its own reference to the Blob once it starts
+                setTimeout(() => URL.revokeObjectURL(url), 1000);
                 
                 const btn = document.getElementById('downloadBtn');
                 const originalHTML = btn.innerHTML;
@@ -758,6 +2992,13 @@ class EdgeTTSHandler(SimpleHTTPRequestHandler):
             updateCharCount();
             updateRateDisplay();
             
+            // Caches the page, icons and previews so the UI also loads offline
+            if ('serviceWorker' in navigator) {
+                navigator.serviceWorker.register('/sw.js').catch(error => {
+                    console.log('Service worker registration failed:', error);
+                });
+            }
+            
             document.getElementById('text').addEventListener('input', updateCharCount);
             
             document.addEventListener('keydown', (e) => {
@@ -773,144 +3014,1066 @@ class EdgeTTSHandler(SimpleHTTPRequestHandler):
     </script>
 </body>
 </html>"""
+
+# The page never changes while the server runs, so encode and compress it once
+INDEX_PAGE = StaticAsset(INDEX_HTML.encode('utf-8'), 'text/html; charset=utf-8')
+
+# Keeps the UI usable offline. The cache name carries the page's digest, so a
+# changed page changes this script and the browser installs it afresh.
+SERVICE_WORKER_JS = """const CACHE = 'edge-tts-__VERSION__';
+
+self.addEventListener('install', (event) => {
+    event.waitUntil(caches.open(CACHE).then((cache) => cache.add('/')).then(() => self.skipWaiting()));
+});
+
+self.addEventListener('activate', (event) => {
+    event.waitUntil(caches.keys().then((names) => Promise.all(
+        names.filter((name) => name.startsWith('edge-tts-') && name !== CACHE).map((name) => caches.delete(name))
+    )).then(() => self.clients.claim()));
+});
+
+async function cacheFirst(request) {
+    const cached = await caches.match(request);
+    if (cached) {
+        return cached;
+    }
+    const response = await fetch(request);
+    // Partial (206) responses can't be cached; cross-origin ones are opaque
+    if (response.status === 200 || response.type === 'opaque') {
+        const cache = await caches.open(CACHE);
+        await cache.put(request, response.clone());
+    }
+    return response;
+}
+
+async function networkFirst(request) {
+    try {
+        const response = await fetch(request);
+        if (response.status === 200) {
+            const cache = await caches.open(CACHE);
+            await cache.put(request, response.clone());
+        }
+        return response;
+    } catch (error) {
+        const cached = await caches.match(request);
+        if (cached) {
+            return cached;
+        }
+        throw error;
+    }
+}
+
+self.addEventListener('fetch', (event) => {
+    const request = event.request;
+    if (request.method !== 'GET') {
+        return;
+    }
+    const url = new URL(request.url);
+    if (url.origin !== self.location.origin) {
+        // Icon styles and fonts from the CDN are versioned by their URL
+        event.respondWith(cacheFirst(request));
+    } else if (url.pathname.startsWith('/preview/') || url.pathname.startsWith('/audio/')) {
+        // Previews rarely change and /audio/ URLs never do
+        event.respondWith(cacheFirst(request));
+    } else if (url.pathname === '/' || url.pathname === '/index.html') {
+        // Fresh when online, the cached copy when not
+        event.respondWith(networkFirst(request));
+    }
+});
+"""
+
+SERVICE_WORKER = StaticAsset(SERVICE_WORKER_JS.replace('__VERSION__', INDEX_PAGE.variants['identity'][1].strip('"'))
+                             .encode('utf-8'), 'text/javascript; charset=utf-8')
+
+
+class EdgeTTSHandler(SimpleHTTPRequestHandler):
+    # HTTP/1.1 gives persistent connections and chunked streaming responses
+    protocol_version = 'HTTP/1.1'
+    # Idle keep-alive connections are dropped after this many seconds
+    timeout = KEEPALIVE_TIMEOUT
+    max_requests_per_connection = MAX_KEEPALIVE_REQUESTS
+    
+    def setup(self):
+        super().setup()
+        self.requests_handled = 0
+        self.chunked = True
+    
+    def parse_request(self):
+        parsed = super().parse_request()
+        if parsed:
+            self.requests_handled += 1
+            self.request_started = time.perf_counter()
+            metrics.inc('tts_http_requests_in_flight')
+        return parsed
+    
+    def handle_one_request(self):
+        self.request_started = None
+        self.response_status = None
+        try:
+            super().handle_one_request()
+        except (BrokenPipeError, ConnectionResetError):
+            # The client hung up before its response could be written
+            logger.info(f"Client {self.client_address[0]} disconnected")
+            self.close_connection = True
+        finally:
+            if self.request_started is not None:
+                route = self.route_label()
+                metrics.inc('tts_http_requests_in_flight', -1)
+                metrics.observe('tts_http_request_duration_seconds',
+                                time.perf_counter() - self.request_started, route=route)
+                metrics.inc('tts_http_requests_total', route=route, status=self.response_status)
+    
+    def send_response(self, code, message=None):
+        self.response_status = code
+        self.connection_header_sent = False
+        super().send_response(code, message)
+    
+    def send_header(self, keyword, value):
+        if keyword.lower() == 'connection':
+            self.connection_header_sent = True
+        super().send_header(keyword, value)
+    
+    def route_label(self):
+        """Collapse the request path into a low-cardinality metrics label"""
+        path = urlsplit(self.path).path
+        if path.startswith('/jobs/'):
+            parts = path.strip('/').split('/')
+            if len(parts) == 2:
+                return '/jobs/{id}'
+            # Only known resources, so clients can't mint new label values
+            if len(parts) == 3 and parts[2] in ('events', 'audio', 'subtitles'):
+                return f'/jobs/{{id}}/{parts[2]}'
+            return 'other'
+        if path.startswith('/preview/'):
+            return '/preview/{voice}'
+        if path.startswith('/audio/'):
+            return '/audio/{hash}'
+        if path in ('/', '/index.html', '/sw.js', '/favicon.ico', '/metrics', '/jobs',
+                    '/tts', '/tts/stream', '/tts/batch', '/tts/subtitles'):
+            return path
+        return 'other'
+    
+    def end_headers(self):
+        # Advertise keep-alive limits, and close once the per-connection cap is hit
+        if self.close_connection:
+            # Pipelining clients must know their queued requests won't be answered here
+            if not self.connection_header_sent:
+                self.send_header('Connection', 'close')
+        else:
+            if self.requests_handled >= self.max_requests_per_connection or self.server.draining:
+                self.send_header('Connection', 'close')
+            else:
+                if self.request_version == 'HTTP/1.0':
+                    self.send_header('Connection', 'keep-alive')
+                remaining = self.max_requests_per_connection - self.requests_handled
+                self.send_header('Keep-Alive', f'timeout={self.timeout}, max={remaining}')
+        super().end_headers()
+    
+    def do_GET(self):
+        if self.path == '/' or self.path == '/index.html':
+            self.send_asset(INDEX_PAGE)
             
-            self.wfile.write(html.encode('utf-8'))
+        elif self.path == '/sw.js':
+            self.send_asset(SERVICE_WORKER)
             
         elif self.path == '/favicon.ico':
             self.send_response(204)
             self.end_headers()
             
+        elif self.path.startswith('/jobs/'):
+            self.handle_job_get()
+            
+        elif self.path == '/metrics':
+            self.handle_metrics()
+            
+        elif self.path.startswith('/preview/'):
+            self.handle_preview()
+            
+        elif self.path.startswith('/audio/'):
+            self.handle_audio()
+            
         else:
             super().do_GET()
     
-    def do_POST(self):
-        if self.path == '/tts':
-            self.send_response(200)
-            self.send_header('Content-type', 'application/json')
-            self.send_header('Access-Control-Allow-Origin', '*')
+    def send_asset(self, asset, cache_control='no-cache'):
+        """Serve a StaticAsset, answering 304 when the client's copy is current"""
+        coding, body, etag = asset.select(self.headers.get('Accept-Encoding'))
+        if_none_match = self.headers.get('If-None-Match', '')
+        client_etags = {tag.strip().removeprefix('W/') for tag in if_none_match.split(',')}
+        not_modified = etag in client_etags or if_none_match.strip() == '*'
+        
+        self.send_response(304 if not_modified else 200)
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Vary', 'Accept-Encoding')
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if not_modified:
             self.end_headers()
+            return
+        self.send_header('Content-type', asset.content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if coding != 'identity':
+            self.send_header('Content-Encoding', coding)
+        self.end_headers()
+        self.write_body(body)
+    
+    def do_POST(self):
+        route = urlsplit(self.path)
+        try:
+            # Handlers take an admission slot only once the body has been read
+            if route.path == '/tts':
+                self.handle_tts(route.query)
+            elif route.path == '/tts/stream':
+                self.handle_tts_stream()
+            elif route.path == '/tts/batch':
+                self.handle_tts_batch()
+            elif route.path == '/tts/subtitles':
+                self.handle_tts_subtitles()
+            elif route.path == '/jobs':
+                self.handle_job_submit()
+            else:
+                self.send_error(404, 'Not Found')
+        except Overloaded as e:
+            logger.warning(f"Rejected {route.path} from {self.client_address[0]}: {e}")
+            self.send_overloaded(e)
+    
+    def charge_client(self, chars):
+        """Charge chars to this client's rate limit, raising Overloaded when it is spent"""
+        self.server.admission.charge(self.client_address[0], chars)
+    
+    def send_overloaded(self, error):
+        """Turn a request away with 429 and a Retry-After hint"""
+        retry_after = max(1, math.ceil(error.retry_after))
+        body = json.dumps({'success': False, 'error': str(error), 'retry_after': retry_after})
+        self.send_body(429, 'application/json', body.encode('utf-8'), {'Retry-After': str(retry_after)})
+    
+    def read_json_body(self):
+        """Read and decode the JSON request body"""
+        # Until the whole body is read the connection can't be reused, or
+        # the unread bytes would be parsed as the next request
+        keep_alive = not self.close_connection
+        self.close_connection = True
+        header = self.headers.get('Content-Length')
+        if header is None:
+            raise ValueError('Content-Length header is required')
+        try:
+            content_length = int(header)
+        except ValueError:
+            raise ValueError('Invalid Content-Length header') from None
+        if content_length < 0:
+            raise ValueError('Invalid Content-Length header')
+        post_data = self.rfile.read(content_length)
+        if len(post_data) < content_length:
+            raise ValueError('Request body is incomplete')
+        self.close_connection = not keep_alive
+        return json.loads(post_data.decode('utf-8'))
+    
+    def send_body(self, status, content_type, body, extra_headers=None):
+        """Send a complete response with an exact Content-Length"""
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.write_body(body)
+    
+    def write_body(self, body):
+        """Write a whole response body, recording write time and size"""
+        with metrics.timer('tts_stage_duration_seconds', stage='write'):
+            self.wfile.write(body)
+        metrics.inc('tts_response_bytes_total', len(body), route=self.route_label())
+    
+    def send_json(self, status, payload):
+        """Send a complete JSON response"""
+        self.send_body(status, 'application/json', json.dumps(payload).encode('utf-8'))
+    
+    def send_audio(self, audio_bytes, content_type='audio/mpeg', extra_headers=None):
+        """Send raw audio bytes"""
+        self.send_body(200, content_type, audio_bytes, extra_headers)
+    
+    def wants_binary(self, query):
+        """Decide between raw audio and the JSON envelope for /tts"""
+        response_mode = parse_qs(query).get('response', [''])[0]
+        if response_mode:
+            return response_mode == 'binary'
+        accept = self.headers.get('Accept', '')
+        return 'audio/' in accept
+    
+    def start_chunked(self, content_type, cache_control='no-store'):
+        """Send 200 headers for a response whose length isn't known up front
+
+        HTTP/1.1 clients get chunked transfer encoding. HTTP/1.0 clients
+        don't understand it, so their body is delimited by closing the
+        connection instead.
+        """
+        self.chunked = self.request_version != 'HTTP/1.0'
+        self.send_response(200)
+        self.send_header('Content-type', content_type)
+        self.send_header('Cache-Control', cache_control)
+        self.send_header('Access-Control-Allow-Origin', '*')
+        if self.chunked:
+            self.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+    
+    def write_chunk(self, data):
+        """Write one piece of a response started with start_chunked"""
+        if self.chunked:
+            self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+        else:
+            self.wfile.write(data)
+        metrics.inc('tts_response_bytes_total', len(data), route=self.route_label())
+    
+    def finish_chunked(self):
+        """Terminate a response started with start_chunked"""
+        if self.chunked:
+            self.wfile.write(b"0\r\n\r\n")
+    
+    def handle_tts(self, query=''):
+        """Synthesize the whole text and return it as raw audio or base64 JSON
+
+        Raw audio/mpeg is returned when the query has response=binary or the
+        Accept header asks for audio/*; otherwise the JSON envelope is used.
+        With "subtitles" set, the envelope also carries the word timings.
+        """
+        binary = self.wants_binary(query)
+        
+        try:
+            data = self.read_json_body()
+            text, voice, rate, audio_format = parse_tts_request(data)
+            subtitle_format = parse_subtitle_format(data.get('subtitles'))
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON decode error: {e}")
+            self.send_tts_error(binary, 400, 'Invalid JSON data')
+            return
+        except Exception as e:
+            self.send_tts_error(binary, 400, str(e))
+            return
+        
+        self.charge_client(len(text))
+        logger.info(f"TTS request: voice={voice}, rate={rate}, format={audio_format}, text_length={len(text)}, binary={binary}")
+        
+        rate_str = build_rate_string(rate)
+        # On a miss the engine looks in the store again, and counts it there
+        if binary and self.send_stored_audio(make_cache_key(text, voice, rate, audio_format), count_miss=False):
+            logger.info(f"Served stored {audio_format.upper()} audio")
+            return
+        
+        try:
+            with self.server.admission.slot():
+                # Serve repeats from the cache without going upstream
+                audio_bytes, cached = self.server.engine.get_audio(text, voice, rate, audio_format)
+                # Timings are cached by the synthesis that produced the audio
+                words = self.server.engine.get_words(text, voice, rate) if subtitle_format and not binary else None
+        except Overloaded:
+            raise
+        except Exception as e:
+            logger.error(f"TTS generation error: {e}")
+            self.send_tts_error(binary, 502, str(e))
+            return
+        
+        # Log success
+        voice_name = voice_display_name(voice)
+        word_count = len(text.split())
+        rate_info = f" (Rate: {rate_str})" if rate_str else ""
+        source = "Served cached" if cached else "Generated"
+        logger.info(f"{source} {audio_format.upper()} audio: {voice_name} voice, {word_count} words{rate_info}")
+        
+        url = self.server.engine.publish(make_cache_key(text, voice, rate, audio_format), audio_bytes)
+        self.send_tts_result(binary, audio_bytes, cached, voice, rate, audio_format, words, subtitle_format, url)
+    
+    def send_tts_result(self, binary, audio_bytes, cached, voice, rate, audio_format,
+                        words=None, subtitle_format=None, url=None):
+        """Send finished audio as raw bytes or in the base64 JSON envelope"""
+        if binary:
+            headers = {'X-Cache': 'HIT' if cached else 'MISS'}
+            if url is not None:
+                headers['Content-Location'] = url
+            self.send_audio(audio_bytes, content_type=AUDIO_CONTENT_TYPES[audio_format], extra_headers=headers)
+            return
+        
+        with metrics.timer('tts_stage_duration_seconds', stage='encode'):
+            envelope = {
+                'success': True, 
+                'audio': base64.b64encode(audio_bytes).decode('ascii'),
+                'format': audio_format,
+                'voice': voice,
+                'cached': cached,
+                'settings': {
+                    'rate': rate
+                }
+            }
+            if url is not None:
+                envelope['url'] = url
+            if words is not None:
+                envelope['words'] = words
+                if subtitle_format in ('srt', 'vtt'):
+                    envelope['subtitles'] = format_subtitles(words, subtitle_format)
+            body = json.dumps(envelope).encode('utf-8')
+        self.send_body(200, 'application/json', body)
+    
+    def handle_tts_subtitles(self):
+        """Return the word timings for a /tts body as WebVTT, SRT or JSON
+        
+        Timings are cached with the audio they were captured from, so asking
+        for them after a /tts call for the same text does not go upstream.
+        """
+        try:
+            data = self.read_json_body()
+            text, voice, rate, _ = parse_tts_request(data)
+            subtitle_format = parse_subtitle_format(data.get('subtitles', 'vtt'))
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON decode error: {e}")
+            self.send_json(400, {'success': False, 'error': 'Invalid JSON data'})
+            return
+        except Exception as e:
+            self.send_json(400, {'success': False, 'error': str(e)})
+            return
+        
+        self.charge_client(len(text))
+        try:
+            with self.server.admission.slot():
+                words = self.server.engine.get_words(text, voice, rate)
+        except Overloaded:
+            raise
+        except Exception as e:
+            logger.error(f"TTS generation error: {e}")
+            self.send_json(502, {'success': False, 'error': str(e)})
+            return
+        self.send_subtitles(words, subtitle_format)
+    
+    def send_subtitles(self, words, subtitle_format):
+        body = format_subtitles(words, subtitle_format).encode('utf-8')
+        self.send_body(200, SUBTITLE_CONTENT_TYPES[subtitle_format], body)
+    
+    def send_stored_audio(self, cache_key, count_miss=True):
+        """Send audio straight from the disk store with sendfile, returning False if it isn't there"""
+        store = self.server.engine.store
+        stored = store.open(cache_key, count_miss) if store is not None else None
+        if stored is None:
+            return False
+        file, size, digest = stored
+        with file:
+            offset = audio_offset(cache_key[-1], file)
+            self.send_file(file, size - offset, AUDIO_CONTENT_TYPES[cache_key[-1]],
+                           {'X-Cache': 'HIT', 'Content-Location': f'/audio/{digest}.{cache_key[-1]}'},
+                           offset=offset)
+        return True
+    
+    def send_file(self, file, size, content_type, extra_headers=None, status=200, offset=0):
+        """Send size bytes of file from offset as the body, zero-copy for real files"""
+        self.send_response(status)
+        self.send_header('Content-type', content_type)
+        self.send_header('Content-Length', str(size))
+        self.send_header('Access-Control-Allow-Origin', '*')
+        for name, value in (extra_headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        # The kernel copies a file on disk to the socket without it passing through Python
+        with metrics.timer('tts_stage_duration_seconds', stage='write'):
+            self.connection.sendfile(file, offset, size)
+        metrics.inc('tts_response_bytes_total', size, route=self.route_label())
+    
+    def handle_audio(self):
+        """Serve /audio/<sha256>.<format>, the immutable URL of one synthesized clip
+
+        Clips are named by their content, so they are served with a strong
+        ETag and a year-long immutable Cache-Control, and support single
+        byte ranges for seeking.
+        """
+        match = AUDIO_PATH_RE.fullmatch(urlsplit(self.path).path)
+        stored = self.server.engine.open_audio(*match.groups()) if match else None
+        if stored is None:
+            # In pre-fork mode the clip may be held by another worker process
+            for address in self.server.audio_peers if match else ():
+                if self.proxy_to_worker(address, AUDIO_FORWARDED_HEADERS, fallback=True):
+                    return
+            self.send_json(404, {'success': False, 'error': 'Unknown or expired audio'})
+            return
+        
+        file, size, offset = stored
+        digest, audio_format = match.groups()
+        etag = f'"{digest}"'
+        headers = {
+            'ETag': etag,
+            'Cache-Control': f'public, max-age={AUDIO_MAX_AGE}, immutable',
+            'Accept-Ranges': 'bytes',
+        }
+        with file:
+            client_etags = {tag.strip().removeprefix('W/') for tag in self.headers.get('If-None-Match', '').split(',')}
+            if etag in client_etags or '*' in client_etags:
+                self.send_response(304)
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                return
             
+            # A Range conditioned on some other version is ignored in favour of the whole clip
+            if_range = self.headers.get('If-Range')
             try:
-                content_length = int(self.headers['Content-Length'])
-                post_data = self.rfile.read(content_length)
-                data = json.loads(post_data.decode('utf-8'))
-                
-                text = data.get('text', '').strip()
-                voice = data.get('voice', 'en-US-AriaNeural')
-                rate = data.get('rate', 0)
-                audio_format = data.get('format', 'mp3')
-                
-                logger.info(f"TTS request: voice={voice}, rate={rate}, format={audio_format}, text_length={len(text)}")
-                
-                if not text:
-                    response = {'success': False, 'error': 'No text provided'}
-                elif len(text) > 5000:
-                    response = {'success': False, 'error': 'Text too long (max 5000 characters)'}
-                else:
-                    # Build rate string
-                    if rate == 0:
-                        rate_str = None
-                    else:
-                        if rate > 0:
-                            rate_str = f"+{rate}%"
-                        else:
-                            rate_str = f"{rate}%"
-                    
-                    # Create new event loop for async operations
-                    loop = asyncio.new_event_loop()
-                    asyncio.set_event_loop(loop)
-                    
-                    try:
-                        # Create Edge TTS communicate object
-                        if rate_str:
-                            communicate = edge_tts.Communicate(text, voice, rate=rate_str)
-                        else:
-                            communicate = edge_tts.Communicate(text, voice)
-                        
-                        # Create temporary file
-                        file_extension = audio_format
-                        tmp_file = tempfile.NamedTemporaryFile(delete=False, suffix=f'.{file_extension}')
-                        tmp_filename = tmp_file.name
-                        tmp_file.close()
-                        
-                        try:
-                            # Generate audio
-                            loop.run_until_complete(communicate.save(tmp_filename))
-                            
-                            # Read and encode audio data
-                            with open(tmp_filename, 'rb') as audio_file:
-                                audio_data = base64.b64encode(audio_file.read()).decode()
-                            
-                            response = {
-                                'success': True, 
-                                'audio': audio_data,
-                                'format': audio_format,
-                                'voice': voice,
-                                'settings': {
-                                    'rate': rate
-                                }
-                            }
-                            
-                            # Log success
-                            voice_name = voice.split('-')[2].replace('Neural', '')
-                            word_count = len(text.split())
-                            rate_info = f" (Rate: {rate_str})" if rate_str else ""
-                            logger.info(f"Generated {audio_format.upper()} audio: {voice_name} voice, {word_count} words{rate_info}")
-                        
-                        finally:
-                            # Clean up temporary file with retries
-                            for attempt in range(5):
-                                try:
-                                    if os.path.exists(tmp_filename):
-                                        os.unlink(tmp_filename)
-                                    break
-                                except (PermissionError, OSError) as e:
-                                    if attempt < 4:
-                                        time.sleep(0.1)
-                                    else:
-                                        logger.warning(f"Could not delete temp file {tmp_filename}: {e}")
-                    
-                    finally:
-                        # Close event loop
-                        loop.close()
-                        
-            except json.JSONDecodeError as e:
-                logger.error(f"JSON decode error: {e}")
-                response = {'success': False, 'error': 'Invalid JSON data'}
+                span = parse_range(self.headers.get('Range'), size) if if_range in (None, etag) else None
+            except ValueError:
+                self.send_body(416, 'application/json',
+                               json.dumps({'success': False, 'error': 'Range not satisfiable'}).encode('utf-8'),
+                               {'Content-Range': f'bytes */{size}'})
+                return
+            if span is None:
+                self.send_file(file, size, AUDIO_CONTENT_TYPES[audio_format], headers, offset=offset)
+                return
+            start, end = span
+            headers['Content-Range'] = f'bytes {start}-{end}/{size}'
+            self.send_file(file, end - start + 1, AUDIO_CONTENT_TYPES[audio_format], headers,
+                           status=206, offset=offset + start)
+    
+    def send_tts_error(self, binary, status, message):
+        """Report a /tts failure in the shape the client asked for"""
+        # The JSON envelope has always answered 200 with success=false
+        self.send_json(status if binary else 200, {'success': False, 'error': message})
+    
+    def handle_tts_stream(self):
+        """Stream MP3 audio with chunked encoding as edge_tts produces it"""
+        try:
+            data = self.read_json_body()
+            text, voice, rate, audio_format = parse_tts_request(data)
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON decode error: {e}")
+            self.send_json(400, {'success': False, 'error': 'Invalid JSON data'})
+            return
+        except Exception as e:
+            self.send_json(400, {'success': False, 'error': str(e)})
+            return
+        
+        self.charge_client(len(text))
+        logger.info(f"TTS stream request: voice={voice}, rate={rate}, text_length={len(text)}")
+        
+        # Streaming always delivers the MP3 exactly as edge_tts produces it
+        engine = self.server.engine
+        cache_key = make_cache_key(text, voice, rate, 'mp3')
+        entry = engine.cache.get(cache_key)
+        if entry is not None:
+            audio_bytes = entry_audio(cache_key, entry)
+            self.send_audio(audio_bytes, extra_headers={'X-Cache': 'HIT'})
+            logger.info(f"Served {len(audio_bytes)} cached bytes of audio")
+            return
+        if self.send_stored_audio(cache_key):
+            logger.info("Served stored audio")
+            return
+        
+        with self.server.admission.slot():
+            chunks = engine.iterate(engine.shared_stream(text, voice, rate))
+            
+            # Wait for the first chunk so upstream errors can still get a proper status
+            try:
+                first_chunk = next(chunks, None)
+                if first_chunk is None:
+                    raise RuntimeError('No audio was received from the TTS service')
+            except Exception as e:
+                logger.error(f"TTS stream error: {e}")
+                self.send_json(502, {'success': False, 'error': str(e)})
+                return
+            
+            self.start_chunked('audio/mpeg')
+            
+            total_bytes = 0
+            try:
+                self.write_chunk(first_chunk)
+                total_bytes += len(first_chunk)
+                for chunk in chunks:
+                    self.write_chunk(chunk)
+                    total_bytes += len(chunk)
+                self.finish_chunked()
+                logger.info(f"Streamed {total_bytes} bytes of audio")
+            except (BrokenPipeError, ConnectionResetError):
+                logger.info(f"Client disconnected after {total_bytes} streamed bytes")
+                self.close_connection = True
+            except Exception as e:
+                # Headers are gone already; drop the connection so the client sees a truncated body
+                logger.error(f"TTS stream error after {total_bytes} bytes: {e}")
+                self.close_connection = True
+            finally:
+                chunks.close()
+    
+    def handle_tts_batch(self):
+        """Synthesize a list of jobs and stream NDJSON results as each finishes
+
+        The body is {"jobs": [{text, voice, rate, format}, ...]} (or a bare
+        list). Every line of the response carries the job's index and either
+        its base64 audio or its error, in completion order.
+        """
+        try:
+            data = self.read_json_body()
+            jobs = data.get('jobs') if isinstance(data, dict) else data
+            if not isinstance(jobs, list) or not jobs:
+                raise ValueError('No jobs provided')
+            if len(jobs) > MAX_BATCH_JOBS:
+                raise ValueError(f'Too many jobs (max {MAX_BATCH_JOBS} per batch)')
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON decode error: {e}")
+            self.send_json(400, {'success': False, 'error': 'Invalid JSON data'})
+            return
+        except Exception as e:
+            self.send_json(400, {'success': False, 'error': str(e)})
+            return
+        
+        self.charge_client(sum(len(job['text']) for job in jobs
+                               if isinstance(job, dict) and isinstance(job.get('text'), str)))
+        logger.info(f"TTS batch request: {len(jobs)} jobs")
+        
+        engine = self.server.engine
+        with self.server.admission.slot():
+            results = engine.iterate(engine.run_batch(jobs))
+            
+            self.start_chunked('application/x-ndjson')
+            
+            succeeded = 0
+            try:
+                for result in results:
+                    if result['success']:
+                        result['audio'] = base64.b64encode(result['audio']).decode('ascii')
+                        succeeded += 1
+                    self.write_chunk((json.dumps(result) + '\n').encode('utf-8'))
+                self.finish_chunked()
+                logger.info(f"Batch finished: {succeeded}/{len(jobs)} jobs succeeded")
+            except (BrokenPipeError, ConnectionResetError):
+                logger.info(f"Client disconnected from batch after {succeeded} results")
+                self.close_connection = True
+            except Exception as e:
+                logger.error(f"TTS batch error: {e}")
+                self.close_connection = True
+            finally:
+                results.close()
+    
+    def handle_job_submit(self):
+        """Queue an asynchronous synthesis job and answer at once with its ID"""
+        try:
+            data = self.read_json_body()
+            text, voice, rate, audio_format = parse_tts_request(data)
+        except json.JSONDecodeError as e:
+            logger.error(f"JSON decode error: {e}")
+            self.send_json(400, {'success': False, 'error': 'Invalid JSON data'})
+            return
+        except Exception as e:
+            self.send_json(400, {'success': False, 'error': str(e)})
+            return
+        
+        self.charge_client(len(text))
+        try:
+            job = self.server.jobs.submit(text, voice, rate, audio_format)
+        except JobQueueFull as e:
+            self.send_json(503, {'success': False, 'error': str(e)})
+            return
+        
+        logger.info(f"Queued job {job.id}: voice={voice}, rate={rate}, format={audio_format}, text_length={len(text)}")
+        self.send_json(202, {
+            'success': True,
+            'job': job.to_dict(),
+            'status_url': f'/jobs/{job.id}',
+            'events_url': f'/jobs/{job.id}/events',
+        })
+    
+    def handle_job_get(self):
+        """Serve /jobs/<id> and its /events, /audio and /subtitles resources"""
+        route = urlsplit(self.path)
+        parts = route.path.strip('/').split('/')
+        job = self.server.jobs.get(parts[1]) if len(parts) in (2, 3) else None
+        if job is None:
+            # In pre-fork mode the job may belong to another worker process
+            owner = self.server.job_peers.get(parts[1].split('-', 1)[0]) if len(parts) in (2, 3) else None
+            if owner is not None:
+                self.proxy_to_worker(owner)
+            else:
+                self.send_json(404, {'success': False, 'error': 'Unknown job'})
+            return
+        
+        if len(parts) == 2:
+            self.send_json(200, {'success': True, 'job': job.to_dict()})
+        elif parts[2] == 'events':
+            self.stream_job_events(job)
+        elif parts[2] == 'audio':
+            binary = self.wants_binary(route.query)
+            if job.status == 'failed':
+                self.send_tts_error(binary, 409, job.error)
+            elif job.status != 'done':
+                self.send_tts_error(binary, 409, f'Job is still {job.status}')
+            else:
+                key = make_cache_key(job.text, job.voice, job.rate, job.audio_format)
+                self.send_tts_result(binary, job.audio, job.cached, job.voice, job.rate, job.audio_format,
+                                     url=self.server.engine.publish(key, job.audio))
+        elif parts[2] == 'subtitles':
+            try:
+                subtitle_format = parse_subtitle_format(parse_qs(route.query).get('format', ['vtt'])[0])
+            except ValueError as e:
+                self.send_json(400, {'success': False, 'error': str(e)})
+                return
+            if job.status != 'done':
+                self.send_json(409, {'success': False, 'error': job.error or f'Job is still {job.status}'})
+                return
+            try:
+                words = self.server.engine.get_words(job.text, job.voice, job.rate)
             except Exception as e:
                 logger.error(f"TTS generation error: {e}")
-                response = {'success': False, 'error': str(e)}
+                self.send_json(502, {'success': False, 'error': str(e)})
+                return
+            self.send_subtitles(words, subtitle_format)
+        else:
+            self.send_json(404, {'success': False, 'error': 'Unknown job resource'})
+    
+    def proxy_to_worker(self, address, forward=('Accept', 'Last-Event-ID'), fallback=False):
+        """Relay this GET to the worker process listening on address, streaming the response
+
+        With fallback set, a 404 or an unreachable worker is not relayed and
+        False is returned, so the caller can look elsewhere.
+        """
+        connection = http.client.HTTPConnection(*address, timeout=SSE_HEARTBEAT * 2)
+        try:
+            forwarded = {name: self.headers[name] for name in forward if name in self.headers}
+            connection.request('GET', self.path, headers=forwarded)
+            response = connection.getresponse()
+        except OSError as e:
+            connection.close()
+            if fallback:
+                logger.warning(f"Worker at {address} unavailable: {e}")
+                return False
+            logger.error(f"Job owner at {address} unavailable: {e}")
+            self.send_json(502, {'success': False, 'error': 'Job owner unavailable'})
+            return True
+        if fallback and response.status == 404:
+            connection.close()
+            return False
+        
+        try:
+            length = response.getheader('Content-Length')
+            self.send_response(response.status)
+            for name, value in response.getheaders():
+                if name.lower() not in ('connection', 'keep-alive', 'transfer-encoding', 'date', 'server'):
+                    self.send_header(name, value)
+            if length is not None or response.status in (204, 304):
+                self.end_headers()
+                self.write_body(response.read())
+                return True
             
-            self.wfile.write(json.dumps(response).encode('utf-8'))
+            self.chunked = self.request_version != 'HTTP/1.0'
+            self.send_header('Transfer-Encoding' if self.chunked else 'Connection',
+                             'chunked' if self.chunked else 'close')
+            self.end_headers()
+            while True:
+                data = response.read1(65536)
+                if not data:
+                    break
+                self.write_chunk(data)
+            self.finish_chunked()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+        except (OSError, http.client.HTTPException) as e:
+            # Headers are gone already; drop the connection so the client sees a truncated body
+            logger.error(f"Relaying from worker at {address} failed: {e}")
+            self.close_connection = True
+        finally:
+            connection.close()
+        return True
+    
+    def stream_job_events(self, job):
+        """Push job progress as Server-Sent Events until the job finishes"""
+        self.start_chunked('text/event-stream', cache_control='no-cache')
+        
+        seen_version = -1
+        try:
+            while True:
+                version = job.wait_for_change(seen_version, SSE_HEARTBEAT)
+                if version == seen_version:
+                    self.write_chunk(b": keep-alive\n\n")
+                    continue
+                seen_version = version
+                info = job.to_dict()
+                event = info['status'] if info['status'] in ('done', 'failed') else 'progress'
+                self.write_chunk(f"event: {event}\ndata: {json.dumps(info)}\n\n".encode('utf-8'))
+                if event != 'progress':
+                    break
+            self.finish_chunked()
+        except (BrokenPipeError, ConnectionResetError):
+            self.close_connection = True
+    
+    def handle_preview(self):
+        """Serve a voice preview clip with long-lived cache headers"""
+        name = urlsplit(self.path).path[len('/preview/'):]
+        voice = name[:-len('.mp3')] if name.endswith('.mp3') else name
+        try:
+            asset = self.server.previews.get(voice)
+        except KeyError:
+            self.send_json(404, {'success': False, 'error': f'No preview for voice: {voice}'})
+            return
+        except Exception as e:
+            logger.error(f"Preview rendering error for {voice}: {e}")
+            self.send_json(502, {'success': False, 'error': str(e)})
+            return
+        self.send_asset(asset, cache_control=f'public, max-age={PREVIEW_MAX_AGE}')
+    
+    def handle_metrics(self):
+        """Export metrics in the Prometheus text format"""
+        cache_stats = self.server.engine.cache.stats()
+        metrics.set('tts_cache_hits_total', cache_stats['hits'])
+        metrics.set('tts_cache_misses_total', cache_stats['misses'])
+        metrics.set('tts_cache_evictions_total', cache_stats['evictions'])
+        metrics.set('tts_cache_bytes', cache_stats['bytes'])
+        metrics.set('tts_cache_entries', cache_stats['entries'])
+        if self.server.engine.store is not None:
+            store_stats = self.server.engine.store.stats()
+            metrics.set('tts_store_hits_total', store_stats['hits'])
+            metrics.set('tts_store_misses_total', store_stats['misses'])
+            metrics.set('tts_store_evictions_total', store_stats['evictions'])
+            metrics.set('tts_store_bytes', store_stats['bytes'])
+            metrics.set('tts_store_entries', store_stats['entries'])
+        metrics.set('tts_jobs_queued', self.server.jobs.queued_count())
+        
+        body = metrics.render().encode('utf-8')
+        self.send_body(200, 'text/plain; version=0.0.4; charset=utf-8', body,
+                       extra_headers={'Cache-Control': 'no-store'})
     
     def do_OPTIONS(self):
         """Handle CORS preflight requests"""
         self.send_response(200)
         self.send_header('Access-Control-Allow-Origin', '*')
         self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+        self.send_header('Access-Control-Allow-Headers', 'Content-Type, Range')
+        self.send_header('Access-Control-Max-Age', '86400')
+        self.send_header('Content-Length', '0')
         self.end_headers()
     
     def log_message(self, format, *args):
         """Override to use logging instead of print"""
         logger.info(f"{self.address_string()} - {format % args}")
 
-def start_server():
-    """Start the Edge TTS server"""
-    port = 8000
-    host = 'localhost'
+def make_http_server(mode, address, listen_socket=None):
+    """Create the bare HTTP server for mode, binding address unless a socket is given"""
+    if mode not in SERVER_MODES:
+        raise ValueError(f"Unknown server mode: {mode} (choose from {', '.join(SERVER_MODES)})")
     
+    if listen_socket is None:
+        server = SERVER_MODES[mode](address, EdgeTTSHandler)
+    else:
+        server = SERVER_MODES[mode](listen_socket.getsockname()[:2], EdgeTTSHandler, bind_and_activate=False)
+        server.socket.close()
+        server.socket = listen_socket
+    server.daemon_threads = True
+    server.draining = False
+    server.job_peers = {}
+    # Workers asked for /audio/ clips this one doesn't hold
+    server.audio_peers = ()
+    return server
+
+def create_server(host=DEFAULT_HOST, port=DEFAULT_PORT, mode=DEFAULT_MODE,
+                  max_concurrency=MAX_CONCURRENT_SYNTHESIS, cache_max_bytes=CACHE_MAX_BYTES,
+                  cache_ttl=CACHE_TTL, segment_workers=SEGMENT_WORKERS, max_in_flight=MAX_IN_FLIGHT_REQUESTS,
+                  max_waiting=MAX_WAITING_REQUESTS, admission_timeout=ADMISSION_TIMEOUT,
+                  client_chars_per_second=CLIENT_CHARS_PER_SECOND, client_burst_chars=CLIENT_BURST_CHARS,
+                  upstream_pool_size=UPSTREAM_POOL_SIZE, upstream_url=None, first_chunk_timeout=FIRST_CHUNK_TIMEOUT,
+                  synthesis_timeout=SYNTHESIS_TIMEOUT, hedge_percentile=HEDGE_PERCENTILE, store_dir=None,
+                  store_max_bytes=STORE_MAX_BYTES, store_peers=(), listen_socket=None, engine=None):
+    """Build an HTTP server bound to host:port with its own synthesis engine
+
+    With listen_socket, the server accepts on that already listening
+    socket instead of binding host:port itself. With store_dir, finished
+    audio is also kept on disk there and survives restarts.
+    """
+    server = make_http_server(mode, (host, port), listen_socket)
+    if engine is None:
+        cache = AudioCache(max_bytes=cache_max_bytes, ttl=cache_ttl)
+        store = AudioStore(store_dir, max_bytes=store_max_bytes, peers=store_peers) if store_dir else None
+        engine = TTSEngine(max_concurrency=max_concurrency, cache=cache,
+                           segment_workers=segment_workers, upstream_pool_size=upstream_pool_size,
+                           upstream_url=upstream_url, first_chunk_timeout=first_chunk_timeout,
+                           synthesis_timeout=synthesis_timeout, hedge_percentile=hedge_percentile,
+                           store=store)
+    server.engine = engine
+    server.engine.start()
+    logger.info(f"Audio encoders available: {', '.join(['mp3', *sorted(ENCODERS)])}")
+    server.jobs = JobManager(engine)
+    server.jobs.start()
+    server.previews = PreviewStore(engine)
+    server.admission = AdmissionController(max_in_flight=max_in_flight, max_waiting=max_waiting,
+                                           wait_timeout=admission_timeout,
+                                           chars_per_second=client_chars_per_second,
+                                           burst_chars=client_burst_chars)
+    return server
+
+class PreforkSupervisor:
+    """Serve from forked worker processes that all accept on one listening socket.
+
+    The supervisor binds the public socket, plus one loopback socket per
+    worker slot through which a worker relays requests for jobs another
+    worker owns, then forks the workers and restarts any that die.
+    SIGTERM or Ctrl+C makes every worker stop accepting, finish the
+    requests and jobs it has in flight (for up to DRAIN_TIMEOUT seconds)
+    and exit.
+    """
+
+    def __init__(self, host, port, workers, options, prerender_previews=False):
+        if not hasattr(os, 'fork'):
+            raise OSError('Pre-fork mode needs os.fork(), which this platform lacks')
+        self.workers = workers
+        self.options = options
+        self.prerender_previews = prerender_previews
+        self.listener = socket.create_server((host, port))
+        # Every worker is woken for each connection, and the ones that lose the race must not block in accept()
+        self.listener.setblocking(False)
+        self.internal_sockets = [socket.create_server(('127.0.0.1', 0)) for _ in range(workers)]
+        self.job_peers = {str(slot): sock.getsockname()[:2] for slot, sock in enumerate(self.internal_sockets)}
+        self.children = {}
+        self.stopping = False
+
+    def run(self):
+        """Fork the workers and supervise them until all have exited after a stop"""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for slot in range(self.workers):
+            self._spawn(slot)
+        
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            slot, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            logger.warning(f"Worker {slot} (pid {pid}) exited with code {os.waitstatus_to_exitcode(status)}, restarting")
+            if time.monotonic() - started < 1:
+                # Don't spin on a worker that dies right at startup
+                time.sleep(1)
+            if not self.stopping:
+                self._spawn(slot)
+
+    def close(self):
+        self.listener.close()
+        for sock in self.internal_sockets:
+            sock.close()
+
+    def _stop(self, signum, frame):
+        if not self.stopping:
+            logger.info(f"Draining {len(self.children)} workers...")
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self, slot):
+        pid = os.fork()
+        if pid == 0:
+            code = 1
+            try:
+                self._run_worker(slot)
+                code = 0
+            except Exception:
+                logger.exception(f"Worker {slot} crashed")
+            finally:
+                os._exit(code)
+        self.children[pid] = (slot, time.monotonic())
+
+    def _run_worker(self, slot):
+        # Until the worker can drain, SIGTERM just ends it; Ctrl+C reaches us via the supervisor
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        
+        # The engine's loop thread and process pool have to be created after the fork
+        options = dict(self.options)
+        if options.get('store_dir'):
+            # The index can't be shared between processes, so each slot owns a shard
+            # of the store that its replacement reopens after a restart
+            shards = [os.path.join(options['store_dir'], f'worker-{other}') for other in range(self.workers)]
+            options['store_dir'] = shards[slot]
+            options['store_max_bytes'] //= self.workers
+            # /audio/ URLs are content-addressed, so any worker can serve a clip from any shard
+            options['store_peers'] = shards[:slot] + shards[slot + 1:]
+        server = create_server(mode='threaded', listen_socket=self.listener, **options)
+        server.jobs.id_prefix = f'{slot}-'
+        server.job_peers = self.job_peers
+        # A fresh clip may only be in its worker's memory, or still being written to its shard.
+        # Only the public server relays, so a relayed request never bounces on
+        server.audio_peers = [address for other, address in self.job_peers.items() if other != str(slot)]
+        internal = make_http_server('threaded', None, self.internal_sockets[slot])
+        for name in ('engine', 'jobs', 'previews', 'admission'):
+            setattr(internal, name, getattr(server, name))
+        
+        def drain(signum, frame):
+            logger.info(f"Worker {slot} draining")
+            server.draining = internal.draining = True
+            # shutdown() waits for serve_forever(), which this signal handler interrupted
+            threading.Thread(target=server.shutdown, daemon=True).start()
+        
+        signal.signal(signal.SIGTERM, drain)
+        threading.Thread(target=internal.serve_forever, daemon=True).start()
+        if self.prerender_previews:
+            server.previews.prerender()
+        logger.info(f"Worker {slot} (pid {os.getpid()}) ready")
+        server.serve_forever()
+        
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while time.monotonic() < deadline and (metrics.get('tts_http_requests_in_flight')
+                                               or server.jobs.active_count()):
+            time.sleep(0.1)
+        internal.shutdown()
+        server.engine.stop()
+        logger.info(f"Worker {slot} stopped")
+
+def start_server(host=DEFAULT_HOST, port=DEFAULT_PORT, mode=DEFAULT_MODE,
+                 max_concurrency=MAX_CONCURRENT_SYNTHESIS, cache_max_bytes=CACHE_MAX_BYTES,
+                 cache_ttl=CACHE_TTL, segment_workers=SEGMENT_WORKERS, max_in_flight=MAX_IN_FLIGHT_REQUESTS,
+                 max_waiting=MAX_WAITING_REQUESTS, admission_timeout=ADMISSION_TIMEOUT,
+                 client_chars_per_second=CLIENT_CHARS_PER_SECOND, client_burst_chars=CLIENT_BURST_CHARS,
+                 upstream_pool_size=UPSTREAM_POOL_SIZE, upstream_url=None, first_chunk_timeout=FIRST_CHUNK_TIMEOUT,
+                 synthesis_timeout=SYNTHESIS_TIMEOUT, hedge_percentile=HEDGE_PERCENTILE, store_dir=None,
+                 store_max_bytes=STORE_MAX_BYTES, workers=None, prerender_previews=False):
+    """Start the Edge TTS server"""
+    options = dict(max_concurrency=max_concurrency, cache_max_bytes=cache_max_bytes, cache_ttl=cache_ttl,
+                   segment_workers=segment_workers, max_in_flight=max_in_flight, max_waiting=max_waiting,
+                   admission_timeout=admission_timeout, client_chars_per_second=client_chars_per_second,
+                   client_burst_chars=client_burst_chars, upstream_pool_size=upstream_pool_size,
+                   upstream_url=upstream_url, first_chunk_timeout=first_chunk_timeout,
+                   synthesis_timeout=synthesis_timeout, hedge_percentile=hedge_percentile,
+                   store_dir=store_dir, store_max_bytes=store_max_bytes)
+    server = None
+    supervisor = None
     try:
-        server = HTTPServer((host, port), EdgeTTSHandler)
+        if mode == 'prefork':
+            workers = workers or os.cpu_count() or 1
+            supervisor = PreforkSupervisor(host, port, workers, options, prerender_previews)
+        else:
+            server = create_server(host, port, mode=mode, **options)
+            if prerender_previews:
+                server.previews.prerender()
         logger.info("🚀 Edge TTS Pro Server starting...")
         logger.info(f"📱 Open your browser and go to: http://{host}:{port}")
+        if supervisor is not None:
+            logger.info(f"⚙️  Mode: prefork, {workers} workers with up to {max_concurrency} concurrent syntheses each")
+        else:
+            logger.info(f"⚙️  Mode: {mode}, up to {max_concurrency} concurrent syntheses")
+        logger.info(f"🗃️  Audio cache: {cache_max_bytes // (1024 * 1024)} MB, TTL {cache_ttl}s")
+        if store_dir:
+            logger.info(f"💾 Disk store: {store_dir}, up to {store_max_bytes // (1024 * 1024)} MB")
+        if upstream_pool_size and aiohttp is not None:
+            logger.info(f"🔌 Upstream pool: up to {upstream_pool_size} warm connections")
+        else:
+            logger.info("🔌 Upstream pool disabled, one connection per synthesis")
+        logger.info(f"⏱️  Deadlines: first chunk {first_chunk_timeout}s, synthesis {synthesis_timeout}s, "
+                    f"hedging {f'at p{hedge_percentile * 100:g}' if hedge_percentile else 'off'}")
+        logger.info(f"🚦 Admission: {max_in_flight} in flight, {max_waiting} waiting, "
+                    f"{client_chars_per_second} chars/s per client")
         logger.info("🇺🇸 English voices: Aria, Jenny, Guy, Andrew, Sonia, Ryan, Natasha, William")
         logger.info("🇸🇦 Arabic voices: Zariyah, Hamed, Salma, Shakir")
         logger.info("✨ Only verified, working voices included!")
         logger.info("⌨️  Keyboard shortcuts: Ctrl+Enter (convert), Ctrl+D (download)")
         logger.info("⏹️  Press Ctrl+C to stop the server")
         logger.info("-" * 60)
-        server.serve_forever()
+        if supervisor is not None:
+            supervisor.run()
+            logger.info("👋 Server stopped. Thanks for using Edge TTS Pro!")
+        else:
+            server.serve_forever()
     except KeyboardInterrupt:
         logger.info("\n👋 Server stopped. Thanks for using Edge TTS Pro!")
     except OSError as e:
@@ -920,6 +4083,69 @@ def start_server():
             logger.error(f"❌ Server error: {e}")
     except Exception as e:
         logger.error(f"❌ Unexpected error: {e}")
+    finally:
+        if server is not None:
+            server.server_close()
+            server.engine.stop()
+        if supervisor is not None:
+            supervisor.close()
+
+def parse_args(argv=None):
+    """Parse command line options for the server"""
+    parser = argparse.ArgumentParser(description="Edge TTS Pro server")
+    parser.add_argument('--host', default=DEFAULT_HOST, help="Interface to bind (default: %(default)s)")
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT, help="Port to listen on (default: %(default)s)")
+    parser.add_argument('--mode', choices=sorted([*SERVER_MODES, 'prefork']), default=DEFAULT_MODE,
+                        help="'threaded' serves requests concurrently, 'single' one at a time, 'prefork' "
+                             "from several threaded worker processes (default: %(default)s)")
+    parser.add_argument('--workers', type=int,
+                        help="Worker processes in prefork mode (default: one per CPU)")
+    parser.add_argument('--max-concurrency', type=int, default=MAX_CONCURRENT_SYNTHESIS,
+                        help="Maximum number of concurrent upstream syntheses (default: %(default)s)")
+    parser.add_argument('--cache-size-mb', type=int, default=CACHE_MAX_BYTES // (1024 * 1024),
+                        help="Size budget of the in-memory audio cache in MB (default: %(default)s)")
+    parser.add_argument('--cache-ttl', type=int, default=CACHE_TTL,
+                        help="Seconds before a cached clip expires, 0 to never expire (default: %(default)s)")
+    parser.add_argument('--store-dir',
+                        help="Keep finished audio on disk in this directory, across restarts (default: off)")
+    parser.add_argument('--store-size-mb', type=int, default=STORE_MAX_BYTES // (1024 * 1024),
+                        help="Disk space the audio store may use in MB (default: %(default)s)")
+    parser.add_argument('--segment-workers', type=int, default=SEGMENT_WORKERS,
+                        help="Sentences of one long text synthesized in parallel (default: %(default)s)")
+    parser.add_argument('--max-in-flight', type=int, default=MAX_IN_FLIGHT_REQUESTS,
+                        help="Synthesis requests handled at once, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--max-waiting', type=int, default=MAX_WAITING_REQUESTS,
+                        help="Requests that may wait for a free slot before getting 429 (default: %(default)s)")
+    parser.add_argument('--admission-timeout', type=float, default=ADMISSION_TIMEOUT,
+                        help="Seconds a request may wait for a free slot (default: %(default)s)")
+    parser.add_argument('--client-chars-per-second', type=float, default=CLIENT_CHARS_PER_SECOND,
+                        help="Characters per second each client may synthesize, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--client-burst-chars', type=int, default=CLIENT_BURST_CHARS,
+                        help="Characters a client may synthesize in one burst (default: %(default)s)")
+    parser.add_argument('--upstream-pool-size', type=int, default=UPSTREAM_POOL_SIZE,
+                        help="Warm upstream connections kept for reuse, 0 for a fresh one per synthesis (default: %(default)s)")
+    parser.add_argument('--upstream-url',
+                        help="WebSocket URL of the synthesis service, e.g. a local stand-in for testing")
+    parser.add_argument('--first-chunk-timeout', type=float, default=FIRST_CHUNK_TIMEOUT,
+                        help="Seconds to wait for the first audio of a synthesis, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--synthesis-timeout', type=float, default=SYNTHESIS_TIMEOUT,
+                        help="Seconds one synthesis may take in total, 0 for no limit (default: %(default)s)")
+    parser.add_argument('--hedge-percentile', type=float, default=HEDGE_PERCENTILE * 100,
+                        help="Start a second synthesis when the first has sent no audio by this percentile "
+                             "of recent first-chunk times, e.g. 95; 0 disables hedging (default: %(default)s)")
+    parser.add_argument('--prerender-previews', action='store_true',
+                        help="Render all voice previews at startup instead of on first use")
+    return parser.parse_args(argv)
 
 if __name__ == '__main__':
-    start_server()
+    args = parse_args()
+    start_server(args.host, args.port, mode=args.mode, max_concurrency=args.max_concurrency,
+                 cache_max_bytes=args.cache_size_mb * 1024 * 1024, cache_ttl=args.cache_ttl,
+                 store_dir=args.store_dir, store_max_bytes=args.store_size_mb * 1024 * 1024,
+                 segment_workers=args.segment_workers, max_in_flight=args.max_in_flight,
+                 max_waiting=args.max_waiting, admission_timeout=args.admission_timeout,
+                 client_chars_per_second=args.client_chars_per_second,
+                 client_burst_chars=args.client_burst_chars, upstream_pool_size=args.upstream_pool_size,
+                 upstream_url=args.upstream_url, first_chunk_timeout=args.first_chunk_timeout,
+                 synthesis_timeout=args.synthesis_timeout, hedge_percentile=args.hedge_percentile / 100,
+                 workers=args.workers, prerender_previews=args.prerender_previews)
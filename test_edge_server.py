@@ -0,0 +1,304 @@
+"""Tests for edge_server"""
+import hashlib
+import os
+from types import SimpleNamespace
+
+import pytest
+
+import edge_server
+from edge_server import (AdmissionController, AudioCache, AudioStore, Overloaded, audio_offset, canonicalize_rate,
+                         canonicalize_text, make_cache_key, pack_entry, parse_range)
+
+
+def key(text, audio_format='wav'):
+    return make_cache_key(text, 'en-US-AriaNeural', 0, audio_format)
+
+
+def clip_path(store, data, extension='wav'):
+    return store._path(hashlib.sha256(data).digest(), extension)
+
+
+# AudioCache
+
+def test_cache_counts_each_lookup_once():
+    cache = AudioCache(max_bytes=1000)
+    assert cache.get(key('one'), count_miss=False) is None
+    assert cache.get(key('one')) is None
+    cache.put(key('one'), b'audio')
+    assert cache.get(key('one'), count_miss=False) == b'audio'
+    assert cache.get(key('one'), count_miss=False, count_hit=False) == b'audio'
+    assert cache.get(key('two'), count_miss=False, count_hit=False) is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+# AudioStore
+
+def test_store_reopens_with_its_clips(tmp_path):
+    store = AudioStore(str(tmp_path))
+    store.put(key('one'), b'first clip')
+    store.put(key('two', 'ogg'), b'[]')
+    store.close()
+
+    store = AudioStore(str(tmp_path))
+    assert store.read(key('one')) == b'first clip'
+    assert store.read(key('two', 'ogg')) == b'[]'
+    assert store.read(key('three')) is None
+    assert store.stats()['entries'] == 2
+    assert store.stats()['bytes'] == len(b'first clip') + len(b'[]')
+    store.close()
+
+
+def test_store_shares_identical_audio(tmp_path):
+    store = AudioStore(str(tmp_path))
+    store.put(key('one'), b'same audio')
+    store.put(key('two'), b'same audio')
+    assert store.stats()['bytes'] == len(b'same audio')
+    assert store.open(key('one'))[2] == store.open(key('two'))[2]
+    store.close()
+
+
+def test_store_overwrite_keeps_clip_shared_with_another_key(tmp_path):
+    store = AudioStore(str(tmp_path))
+    store.put(key('one'), b'shared audio')
+    store.put(key('two'), b'shared audio')
+    store.put(key('one'), b'new audio')
+
+    assert store.read(key('one')) == b'new audio'
+    assert store.read(key('two')) == b'shared audio'
+    assert os.path.exists(clip_path(store, b'shared audio'))
+
+    # Once the last key using it moves on, the clip is deleted
+    store.put(key('two'), b'new audio')
+    assert not os.path.exists(clip_path(store, b'shared audio'))
+    assert store.stats()['bytes'] == len(b'new audio')
+    store.close()
+
+
+def test_store_overwrite_with_same_audio(tmp_path):
+    store = AudioStore(str(tmp_path))
+    store.put(key('one'), b'audio')
+    store.put(key('one'), b'audio')
+    assert store.read(key('one')) == b'audio'
+    assert store.stats() == {'entries': 1, 'bytes': 5, 'max_bytes': store.max_bytes,
+                             'hits': 1, 'misses': 0, 'evictions': 0}
+    store.close()
+
+
+def test_store_drops_corrupted_slot(tmp_path):
+    store = AudioStore(str(tmp_path))
+    store.put(key('kept'), b'kept audio')
+    store.put(key('torn'), b'torn audio')
+    slot = store._entries[AudioStore.key_digest(key('torn'))][0]
+    offset = store._offset(slot)
+    store.close()
+
+    with open(tmp_path / 'index', 'r+b') as index:
+        index.seek(offset + 20)
+        byte = index.read(1)
+        index.seek(offset + 20)
+        index.write(bytes([byte[0] ^ 0xFF]))
+
+    store = AudioStore(str(tmp_path))
+    assert store.read(key('torn')) is None
+    assert store.read(key('kept')) == b'kept audio'
+    assert store.stats()['entries'] == 1
+    # The dropped slot is reused rather than leaking
+    store.put(key('new'), b'new audio')
+    store.close()
+    store = AudioStore(str(tmp_path))
+    assert store.read(key('new')) == b'new audio'
+    store.close()
+
+
+def test_store_ignores_unrecognized_index(tmp_path):
+    (tmp_path / 'index').write_bytes(b'not an index')
+    store = AudioStore(str(tmp_path))
+    assert store.stats()['entries'] == 0
+    store.put(key('one'), b'audio')
+    assert store.read(key('one')) == b'audio'
+    store.close()
+
+
+def test_store_grows_index(tmp_path, monkeypatch):
+    monkeypatch.setattr(edge_server, 'STORE_INITIAL_SLOTS', 2)
+    store = AudioStore(str(tmp_path))
+    for i in range(5):
+        store.put(key(f'clip {i}'), f'audio {i}'.encode())
+    store.close()
+
+    store = AudioStore(str(tmp_path))
+    assert store._capacity == 8
+    assert [store.read(key(f'clip {i}')) for i in range(5)] == [f'audio {i}'.encode() for i in range(5)]
+    store.close()
+
+
+def test_store_evicts_least_recently_used(tmp_path):
+    store = AudioStore(str(tmp_path), max_bytes=20)
+    store.put(key('one'), b'a' * 8)
+    store.put(key('two'), b'b' * 8)
+    store.read(key('one'))
+    store.put(key('three'), b'c' * 8)
+
+    assert store.read(key('two')) is None
+    assert store.read(key('one')) == b'a' * 8
+    assert store.read(key('three')) == b'c' * 8
+    assert not os.path.exists(clip_path(store, b'b' * 8))
+    assert store.stats()['evictions'] == 1
+    store.close()
+
+
+def test_store_keeps_timings_with_mp3(tmp_path):
+    words = [{'text': 'Hello', 'offset': 0.1, 'duration': 0.4}]
+    entry = pack_entry(b'mp3 audio', words)
+    store = AudioStore(str(tmp_path))
+    store.put(key('one', 'mp3'), entry)
+    assert store.read(key('one', 'mp3')) == entry
+
+    # Keys whose audio is the same but whose timings differ keep their own clips
+    store.put(key('two', 'mp3'), pack_entry(b'mp3 audio', []))
+    assert store.read(key('one', 'mp3')) == entry
+
+    file, size = store.open_content(hashlib.sha256(entry).digest(), 'mp3')
+    with file:
+        offset = audio_offset('mp3', file)
+        file.seek(offset)
+        assert file.read(size - offset) == b'mp3 audio'
+    store.close()
+
+
+def test_store_removes_leftover_temp_files(tmp_path):
+    (tmp_path / 'partial.tmp').write_bytes(b'half a clip')
+    AudioStore(str(tmp_path)).close()
+    assert not (tmp_path / 'partial.tmp').exists()
+
+
+# parse_range
+
+@pytest.mark.parametrize('header, expected', [
+    ('bytes=0-99', (0, 99)),
+    ('bytes=500-', (500, 999)),
+    ('bytes=900-5000', (900, 999)),
+    ('bytes=-100', (900, 999)),
+    ('bytes=-5000', (0, 999)),
+    ('Bytes = 10-19', (10, 19)),
+])
+def test_parse_range(header, expected):
+    assert parse_range(header, 1000) == expected
+
+
+@pytest.mark.parametrize('header', [
+    None,
+    '',
+    'items=0-99',
+    'bytes=0-99,200-299',
+    'bytes=-100, 0-1',
+    'bytes=99-0',
+    'bytes=a-b',
+])
+def test_parse_range_sends_whole_body(header):
+    assert parse_range(header, 1000) is None
+
+
+@pytest.mark.parametrize('header', ['bytes=1000-', 'bytes=1000-1100', 'bytes=-0'])
+def test_parse_range_past_the_end(header):
+    with pytest.raises(ValueError):
+        parse_range(header, 1000)
+
+
+# Canonicalization
+
+@pytest.mark.parametrize('text, expected', [
+    # Decomposed accents are composed
+    ('cafe\u0301', 'caf\u00e9'),
+    ('zero\u200bwidth\u200d\u2060\ufeff', 'zerowidth'),
+    # The zero-width non-joiner changes Persian letter shapes, so it stays
+    ('\u0645\u06cc\u200c\u062e\u0648\u0627\u0647\u0645', '\u0645\u06cc\u200c\u062e\u0648\u0627\u0647\u0645'),
+    ('\u0639\u0640\u0640\u0631\u0628\u064a', '\u0639\u0631\u0628\u064a'),
+    ('one  \t two\nthree', 'one two three'),
+    ('First.\n \n\tSecond.\n\n\n\nThird.', 'First.\n\nSecond.\n\nThird.'),
+    ('  \n padded \n ', 'padded'),
+])
+def test_canonicalize_text(text, expected):
+    assert canonicalize_text(text) == expected
+
+
+def test_canonicalize_text_is_idempotent():
+    text = canonicalize_text(' Cafe\u0301\u200b  au\n\n\nlait\u0640 ')
+    assert canonicalize_text(text) == text
+
+
+@pytest.mark.parametrize('rate, expected', [
+    (0, 0), (10, 10), (10.0, 10), (-20, -20), ('10', 10), ('+10%', 10), (' -5 % ', -5),
+])
+def test_canonicalize_rate(rate, expected):
+    assert canonicalize_rate(rate) == expected
+
+
+@pytest.mark.parametrize('rate', [True, 10.5, 'fast', '10%%', None])
+def test_canonicalize_rate_rejects(rate):
+    with pytest.raises(ValueError):
+        canonicalize_rate(rate)
+
+
+def test_spelling_variants_share_a_cache_key():
+    variants = [
+        {'text': 'Caf\u00e9  ole', 'rate': 10},
+        {'text': ' Cafe\u0301 ole\u200b', 'voice': ' en-US-AriaNeural', 'rate': '+10%', 'format': 'MP3'},
+    ]
+    keys = {make_cache_key(*edge_server.parse_tts_request(data)) for data in variants}
+    assert len(keys) == 1
+
+
+# Admission control
+
+def test_first_request_may_use_the_whole_burst():
+    admission = AdmissionController(chars_per_second=1, burst_chars=5)
+    admission.charge('client', 30)
+
+
+def test_first_request_at_default_limits():
+    admission = AdmissionController()
+    admission.charge('client', 20000)
+
+
+def test_oversized_request_leaves_client_in_debt():
+    admission = AdmissionController(chars_per_second=10, burst_chars=100)
+    admission.charge('client', 250)
+    with pytest.raises(Overloaded) as error:
+        admission.charge('client', 1)
+    assert error.value.retry_after == pytest.approx(15.1, abs=0.1)
+    # Other clients have buckets of their own
+    admission.charge('other', 100)
+
+
+def test_rate_limit_disabled():
+    admission = AdmissionController(chars_per_second=0)
+    for _ in range(3):
+        admission.charge('client', 10 ** 6)
+
+
+def test_slot_queue_full():
+    admission = AdmissionController(max_in_flight=1, max_waiting=0)
+    with admission.slot():
+        with pytest.raises(Overloaded):
+            with admission.slot():
+                pass
+    with admission.slot():
+        assert admission.in_flight == 1
+    assert admission.in_flight == 0
+
+
+# Metrics labels
+
+@pytest.mark.parametrize('path, label', [
+    ('/tts', '/tts'),
+    ('/jobs/1-abc', '/jobs/{id}'),
+    ('/jobs/1-abc/events?x=1', '/jobs/{id}/events'),
+    ('/jobs/1-abc/subtitles', '/jobs/{id}/subtitles'),
+    ('/jobs/1-abc/random0', 'other'),
+    ('/jobs/1-abc/audio/extra', 'other'),
+    ('/audio/' + 'ab' * 32 + '.mp3', '/audio/{hash}'),
+    ('/anything', 'other'),
+])
+def test_route_label(path, label):
+    assert edge_server.EdgeTTSHandler.route_label(SimpleNamespace(path=path)) == label